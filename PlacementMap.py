@@ -6,7 +6,14 @@ import networkx as nx
 import numpy as np
 from gdpc import Editor, Block
 
+from coord_batch import CoordBatch, as_coord_batch, batch_in_box
+from instrumentation import report
+from region import Region
+from routing import GridRouter, NetworkxRouter, NoPathException, edge_weight
+from score_cache import ScoreLayerCache
+from terrain_analysis import heightmap_no_trees, air_volume
 from utils import increase_y, coord_in_area
+from window_stats import window_nanvar, window_min, window_sum, WINDOW_FUNCTIONS
 
 
 class NoValidPositionException(Exception):
@@ -16,31 +23,47 @@ class NoValidPositionException(Exception):
 directions_ortho = [(1, 0), (-1, 0), (0, 1), (0, -1)]
 directions_diag = (1, 1), (-1, 1), (-1, -1), (1, -1)
 
+# Maximum amount of blocks a single fill command can change
+FILL_LIMIT = 32768
+
 
 class PlacementMap:
 
-    def __init__(self, editor: Editor, default_precision=1):
+    def __init__(self, editor: Editor, default_precision=1, bulk_terrain_analysis=True, routing_backend='grid',
+                 terrain: tuple[np.ndarray, np.ndarray] | None = None):
+        """terrain is an already known (heightmap without trees, dry mask) of the build area, read from the world
+        slice of the editor otherwise"""
         self.editor = editor
         self.default_precision = default_precision
+        self.bulk_terrain_analysis = bulk_terrain_analysis
+        self.routing_backend = routing_backend
         self.build_area = editor.getBuildArea()
 
-        self.height_map = self.sample_array2d(self.__get_heightmap_no_trees(),
-                                              self.default_precision)
-        self.occupation_map = np.ones_like(self.height_map)
+        if terrain is None:
+            with report.phase('heightmap'):
+                terrain = self.__get_heightmap_no_trees(), self.__get_dry_mask()
+        heightmap, dry_mask = terrain
+        self.height_map = self.sample_array2d(heightmap, self.default_precision)
         # 'Occupy' water
-        for indexes in self.yield_surface_coords():
-            i, j = indexes[0], indexes[2]
-            self.occupation_map[i, j] = self.editor.worldSlice.heightmaps["MOTION_BLOCKING"][i, j] == self.editor.worldSlice.heightmaps["OCEAN_FLOOR"][i, j]
+        self.occupation_map = dry_mask[:self.height_map.shape[0], :self.height_map.shape[1]].astype(self.height_map.dtype)
+        # Cells holding a block placed by an occupy_on_place placer, the roads do not clear above them
+        self.building_map = np.zeros(self.occupation_map.shape, dtype=bool)
 
         self.bonus_map = np.ones_like(self.height_map, dtype=np.float64)
+        self.score_cache = ScoreLayerCache()
 
         self.graph: networkx.Graph | None = None
+        self.router: GridRouter | NetworkxRouter | None = None
         self.all_roads: set[tuple] = set()
         self.roads_infos: dict[str, defaultdict[tuple, int]] = {'INNER': defaultdict(int),
                                                                       'MIDDLE': defaultdict(int),
                                                                       'OUTER': defaultdict(int)}
 
         self.__recently_added_roads = None
+        # Road cells and columns added or reclassified since the last build_roads
+        self.__pending_roads: set[tuple] = set()
+        self.__pending_road_columns: set[tuple] = set()
+        self.__air_volume = None
         self.roads_y = None
 
     def __get_heightmap_no_trees(self) -> np.ndarray:
@@ -51,6 +74,9 @@ class PlacementMap:
         self.editor.loadWorldSlice(cache=True)
         heightmap = self.editor.worldSlice.heightmaps["MOTION_BLOCKING_NO_LEAVES"]
 
+        if self.bulk_terrain_analysis:
+            return heightmap_no_trees(self.editor.worldSlice, heightmap)
+
         for x, rest in enumerate(heightmap):
             for z, h in enumerate(rest):
                 base_coord = (self.build_area.begin.x + x, h - 1, self.build_area.begin.z + z)
@@ -64,6 +90,10 @@ class PlacementMap:
 
         return heightmap
 
+    def __get_dry_mask(self) -> np.ndarray:
+        heightmaps = self.editor.worldSlice.heightmaps
+        return heightmaps["MOTION_BLOCKING"] == heightmaps["OCEAN_FLOOR"]
+
     @staticmethod
     def __any_pattern_in(patterns, _str):
         for p in patterns:
@@ -83,6 +113,8 @@ class PlacementMap:
 
     def compute_variance_map(self, sampling=5, blur_size=3):
         hmap = self.height_map
+        if blur_size > 0:
+            return window_nanvar(hmap, sampling, blur_size)
         return np.array([[np.nanvar(hmap[max(i - blur_size, 0): min(i + blur_size, hmap.shape[0]),
                                     max(j - blur_size, 0): min(j + blur_size, hmap.shape[1])].flatten()) for
                           j in range(0, hmap.shape[1], sampling)] for i in range(0, hmap.shape[0], sampling)])
@@ -98,6 +130,15 @@ class PlacementMap:
             return (x, 0, z)
         return tuple(map(int, (x, self.height_map[tuple(map(int, self.coord_absolute_to_relative(x, z)))], z)))
 
+    def coord2d_to_ground_coords(self, xs, zs) -> CoordBatch:
+        """Vectorized coord2d_to_ground_coord, columns outside of the build area are put at y = 0"""
+        xs, zs = np.asarray(xs, dtype=np.int64), np.asarray(zs, dtype=np.int64)
+        i, j = self.coord_absolute_to_relative(xs, zs)
+        inside = (0 <= i) & (i < self.height_map.shape[0]) & (0 <= j) & (j < self.height_map.shape[1])
+        ys = np.zeros(xs.shape, dtype=np.int64)
+        ys[inside] = self.height_map[i[inside], j[inside]]
+        return as_coord_batch(np.column_stack((xs, ys, zs)))
+
     @staticmethod
     def sample_array2d(array2d, sampling):
         return array2d[::sampling, ::sampling]
@@ -133,32 +174,46 @@ class PlacementMap:
         return - array2d + max_val
 
     def get_flatness_score(self, sampling, blur, factor):
-        return self.oppose_values(self.normalize_2d_array_sum(self.compute_variance_map(sampling, blur), 1)) * factor
+        return self.score_cache.get_layer(('flatness', sampling, blur, factor), lambda: self.oppose_values(
+            self.normalize_2d_array_sum(self.compute_variance_map(sampling, blur), 1)) * factor)
 
     def get_centerness_score(self, shape, factor):
-        return self.generate_decay_matrix(shape[0]) * factor
+        return self.score_cache.get_layer(('centerness', shape, None, factor),
+                                          lambda: self.generate_decay_matrix(shape[0]) * factor)
 
     def get_height_score(self, sampling, factor):
-        return self.normalize_2d_array_sum(self.sample_array2d(self.height_map, sampling), factor)
+        return self.score_cache.get_layer(('height', sampling, None, factor), lambda: self.normalize_2d_array_sum(
+            self.sample_array2d(self.height_map, sampling), factor))
 
     @staticmethod
     def convolut_map(_map, sampling, blur, convolut_fct):
+        # Known statistics are computed in O(1) per window whatever the blur size
+        if blur > 0 and convolut_fct in WINDOW_FUNCTIONS:
+            return WINDOW_FUNCTIONS[convolut_fct](_map, sampling, blur)
         return np.array([[convolut_fct(_map[max(i - blur, 0): min(i + blur, _map.shape[0]),
                           max(j - blur, 0): min(j + blur, _map.shape[1])].flatten()) for
                    j in range(0, _map.shape[1], sampling)] for i in range(0, _map.shape[0], sampling)])
 
     def get_occupation_score(self, sampling, blur):
         _map = self.occupation_map
-        return self.convolut_map(_map, sampling, blur, np.min)
+        if blur <= 0:
+            return self.convolut_map(_map, sampling, blur, np.min)
+        return self.score_cache.get_windowed_layer(('occupation', sampling, blur, None), 'occupation', _map,
+                                                   sampling, blur, window_min)
 
     def get_bonus_score(self, sampling, blur, factor):
-        return self.convolut_map(self.bonus_map, sampling, blur, np.sum) * factor
+        if blur <= 0:
+            return self.convolut_map(self.bonus_map, sampling, blur, np.sum) * factor
+        return self.score_cache.get_windowed_layer(('bonus', sampling, blur, factor), 'bonus', self.bonus_map,
+                                                   sampling, blur, window_sum, factor)
 
     def occupy_area(self, i, j, sampling, radius):
         i *= sampling
         j *= sampling
-        self.occupation_map[max(i - radius, 0): min(i + radius, self.occupation_map.shape[0]),
-        max(j - radius, 0): min(j + radius, self.occupation_map.shape[1])] = 0
+        bounds = (max(i - radius, 0), min(i + radius, self.occupation_map.shape[0]),
+                  max(j - radius, 0), min(j + radius, self.occupation_map.shape[1]))
+        self.occupation_map[bounds[0]: bounds[1], bounds[2]: bounds[3]] = 0
+        self.score_cache.mark_dirty('occupation', *bounds)
 
     def show_steep_map(self, blocks, sampling, blur):
         palette_size = len(blocks)
@@ -186,22 +241,36 @@ class PlacementMap:
             yield i, self.height_map[(i, j)], j
 
     def occupy_coordinate(self, x, z):
-        self.occupation_map[self.coord_absolute_to_relative(x, z)] = 0
-
+        i, j = self.coord_absolute_to_relative(x, z)
+        self.occupation_map[i, j] = 0
+        self.score_cache.mark_dirty('occupation', i, i + 1, j, j + 1)
+
+    def occupy_region(self, region: Region):
+        self.occupation_map[region.mask] = 0
+        bounding_box = region.bounding_box()
+        if bounding_box is not None:
+            (low_x, low_z), (high_x, high_z) = bounding_box
+            low_i, low_j = self.coord_absolute_to_relative(low_x, low_z)
+            high_i, high_j = self.coord_absolute_to_relative(high_x, high_z)
+            self.score_cache.mark_dirty('occupation', low_i, high_i + 1, low_j, high_j + 1)
+
+    @report.timed('get_score_map')
     def get_score_map(self, radius, sampling, flatness_factor, height_factor, centerness_factor, bonus_factor, allow_next_to_occupied_zone):
         height_score = self.get_height_score(sampling, height_factor)
         return height_score \
             * self.get_centerness_score(height_score.shape, centerness_factor) \
             * self.get_flatness_score(sampling, radius, flatness_factor) \
             * self.get_occupation_score(sampling, radius if allow_next_to_occupied_zone else 2 * radius) \
-            * self.get_exclusion_score(height_score.shape, int(radius / sampling)) \
+            * self.score_cache.get_layer(('exclusion', height_score.shape, int(radius / sampling), None),
+                                         lambda: self.get_exclusion_score(height_score.shape, int(radius / sampling))) \
             * self.get_bonus_score(sampling, sampling, bonus_factor)
 
     def add_bonus_on_area(self, indexes, radius, bonus):
         i, j = indexes
-        for a in range(max(0, i - radius), min(self.bonus_map.shape[0], i + radius)):
-            for b in range(max(0, j - radius), min(self.bonus_map.shape[1], j + radius)):
-                self.bonus_map[a, b] *= bonus
+        bounds = (max(0, i - radius), min(self.bonus_map.shape[0], i + radius),
+                  max(0, j - radius), min(self.bonus_map.shape[1], j + radius))
+        self.bonus_map[bounds[0]: bounds[1], bounds[2]: bounds[3]] *= bonus
+        self.score_cache.mark_dirty('bonus', *bounds)
 
     def debug_occupation_area(self):
         for i in range(self.occupation_map.shape[0]):
@@ -229,12 +298,15 @@ class PlacementMap:
 
     def occupy_on_place(self, place_function):
         def new_place_function(coord_iter):
-            coord_list = list(coord_iter)
-            for coord in coord_list:
-                if not self.build_area.contains(coord):
-                    continue
-                self.occupation_map[self.coord_absolute_to_relative(coord[0], coord[2])] = 0
-            place_function(coord_list)
+            batch = as_coord_batch(coord_iter)
+            i, j = self.coord_absolute_to_relative(batch[:, 0], batch[:, 2])
+            inside = batch_in_box(batch, self.build_area)
+            i, j = i[inside], j[inside]
+            if len(i):
+                self.occupation_map[i, j] = 0
+                self.building_map[i, j] = True
+                self.score_cache.mark_dirty('occupation', i.min(), i.max() + 1, j.min(), j.max() + 1)
+            place_function(batch)
 
         return new_place_function
 
@@ -243,7 +315,12 @@ class PlacementMap:
         for d in directions:
             yield coord2d[0] + d[0], coord2d[1] + d[1]
 
+    @report.timed('fill_graph')
     def fill_graph(self):
+        if self.routing_backend == 'grid':
+            self.router = GridRouter(self.height_map, self.coord_relative_to_absolute(0, 0))
+            return
+
         self.graph = nx.Graph()
 
         for coord in self.yield_surface_coords():
@@ -253,24 +330,84 @@ class PlacementMap:
             for directions, factor in [(directions_ortho, 1), (directions_diag, 2)]:
                 for coord in self.coord2d_neighbors(coordinates, directions):
                     if coord in self.graph.nodes.keys():
-                        self.graph.add_edge(coordinates, coord, weight=(100 + (abs(
-                            self.height_map[self.coord_absolute_to_relative(*coord)] - self.height_map[
-                                self.coord_absolute_to_relative(*coordinates)]) * 10) ** 2) * factor)
+                        self.graph.add_edge(coordinates, coord, weight=edge_weight(
+                            self.height_map[self.coord_absolute_to_relative(*coord)],
+                            self.height_map[self.coord_absolute_to_relative(*coordinates)], factor))
+        self.router = NetworkxRouter(self.graph)
 
     def compute_roads(self, start, end) -> bool:
-        if self.graph is None:
+        if self.router is None:
             self.fill_graph()
 
-        try:
-            if type(start) == tuple:
-                path = nx.dijkstra_path(self.graph, start, end)
-            else:
-                path = nx.multi_source_dijkstra(self.graph, start, end)[1]
-
-        except nx.NetworkXException:
-            print("No path found !")
-            return False
+        with report.phase('compute_roads') as counters:
+            try:
+                path = self.router.shortest_path([start] if type(start) == tuple else start, end)
+            except NoPathException:
+                print("No path found !")
+                counters['no_path'] += 1
+                return False
+            finally:
+                counters['nodes_expanded'] += self.router.last_expanded or 0
+
+            counters['paths'] += 1
+            counters['path_length'] += len(path)
+            self.add_road_path(path)
+        return True
+
+    def compute_roads_to_many(self, start, ends, waves=None) -> int:
+        """Compute the roads from start to every end and return how many were found
+
+        With waves=None, every road is routed after the previous one was added, so it is exactly the same as calling
+        compute_roads for each end. Otherwise, the ends are split in `waves` groups routed from a single search each,
+        the discount along existing roads only applying to the roads of the next waves."""
+        ends = list(ends)
+        if waves is None:
+            return sum(self.compute_roads(start, end) for end in ends)
+
+        if self.router is None:
+            self.fill_graph()
+        sources = [start] if type(start) == tuple else start
+        wave_size = -(-len(ends) // waves) if ends else 1
+        found = 0
+        for k in range(0, len(ends), wave_size):
+            with report.phase('compute_roads') as counters:
+                try:
+                    paths = self.router.shortest_paths(sources, ends[k:k + wave_size])
+                except NoPathException:
+                    paths = {}
+                counters['nodes_expanded'] += self.router.last_expanded or 0
+                for end in ends[k:k + wave_size]:
+                    if end not in paths:
+                        print("No path found !")
+                        counters['no_path'] += 1
+                        continue
+                    counters['paths'] += 1
+                    counters['path_length'] += len(paths[end])
+                    self.add_road_path(paths[end])
+                    found += 1
+        return found
+
+    def roads_plan(self) -> dict[str, list]:
+        """Road cells of every road class, as [x, z, times the cell was used] lists"""
+        return {key: [[int(x), int(z), count] for (x, z), count in cells.items()]
+                for key, cells in self.roads_infos.items()}
+
+    def merge_roads_plan(self, roads_plan: dict[str, list]):
+        """Add the road cells of another placement map, as returned by its roads_plan, adding up their counts
+
+        The cells are taken as already built. As in add_road_path, a cell belongs to the first road class using it."""
+        keys = list(self.roads_infos)
+        for rank, key in enumerate(keys):
+            for x, z, count in roads_plan.get(key, []):
+                cell = (x, z)
+                if any(cell in self.roads_infos[earlier] for earlier in keys[:rank]):
+                    continue
+                for later in keys[rank + 1:]:
+                    self.roads_infos[later].pop(cell, None)
+                self.roads_infos[key][cell] += count
+                self.all_roads.add(self.coord2d_to_ground_coord(x, z))
 
+    def add_road_path(self, path):
         self.__recently_added_roads = {'INNER': set(), 'MIDDLE': set(), 'OUTER': set()}
         for coord in path:
             # INNER PART
@@ -297,8 +434,7 @@ class PlacementMap:
 
         # Update weights to use the roads
         for c1, c2 in zip(path[:-2], path[1:]):
-            if self.graph.has_edge(c1, c2):
-                self.graph[c1][c2]['weight'] *= .5
+            self.router.discount_edge(c1, c2, .5)
 
     @staticmethod
     def get_exclusion_score(shape, radius):
@@ -331,6 +467,8 @@ class PlacementMap:
         delete = False
         for key in self.roads_infos:
             if key == placement:
+                if road_coord not in self.roads_infos[key]:
+                    self.__pending_roads.add(road_coord)
                 if road_coord not in self.__recently_added_roads[placement]:
                     self.roads_infos[key][road_coord] += 1
                 delete = True
@@ -342,24 +480,115 @@ class PlacementMap:
                         return
 
         self.__recently_added_roads[placement].add(road_coord)
-        self.all_roads.add(self.coord2d_to_ground_coord(*road_coord))
-        self.occupation_map[self.coord_absolute_to_relative(*road_coord)] = 0
+        ground_coord = self.coord2d_to_ground_coord(*road_coord)
+        if ground_coord not in self.all_roads:
+            self.all_roads.add(ground_coord)
+            self.__pending_road_columns.add(ground_coord)
+        i, j = self.coord_absolute_to_relative(*road_coord)
+        self.occupation_map[i, j] = 0
+        self.score_cache.mark_dirty('occupation', i, i + 1, j, j + 1)
+
+    def __get_air_volume(self):
+        """Return the cached air volume spanning every y a road clearing can reach, and its lowest y
+
+        Blocks cleared by the roads are added to the volume, the world slice does not know about them."""
+        if self.__air_volume is None and self.editor.worldSlice is not None:
+            y_begin = int(self.height_map.min()) + 1
+            self.__air_volume = air_volume(self.editor.worldSlice, y_begin, int(self.height_map.max()) + 20), y_begin
+        return self.__air_volume
 
-    def build_roads(self, floor_pattern: dict[str, dict[str, float]], slab_pattern=None):
+    @staticmethod
+    def __merge_runs(values, max_length):
+        """Yield the (first, last) bounds of the runs of consecutive integers in values"""
+        values = sorted(values)
+        first = last = values[0]
+        for value in values[1:]:
+            if value == last + 1 and value - first < max_length:
+                last = value
+                continue
+            yield first, last
+            first = last = value
+        yield first, last
+
+    def __clear_above_roads(self, road_columns) -> int:
+        """Clear the 19 blocks above the road columns that are not occupied by a building
+
+        Blocks known to be air in the world slice are skipped and columns sharing the same span of blocks to clear
+        are grouped into boxes, each sent as a single fill command. Return the amount of blocks cleared."""
+        y_low, y_high = self.build_area.offset.y, self.build_area.offset.y + self.build_area.size.y - 1
+
+        # The air volume is only built once a column has to be cleared
+        known_air = None
+        spans = defaultdict(list)
+        for x, y, z in road_columns:
+            i, j = self.coord_absolute_to_relative(x, z)
+            # Check for building collision here
+            if self.building_map[i, j]:
+                continue
+            low, high = max(y + 1, y_low), min(y + 19, y_high)
+            if low > high:
+                continue
+            if known_air is None:
+                known_air = self.__get_air_volume() or False
+                if known_air:
+                    volume, volume_y = known_air
+                    decay = self.editor.worldSliceDecay
+                    decay_y = self.editor.worldSlice.yBegin
+            if known_air:
+                is_air = np.zeros(high - low + 1, dtype=bool)
+                known_low, known_high = max(low, volume_y), min(high + 1, volume_y + volume.shape[1])
+                if known_low < known_high:
+                    # Blocks placed since the world slice was loaded are not known anymore
+                    is_air[known_low - low:known_high - low] = \
+                        volume[i, known_low - volume_y:known_high - volume_y, j] \
+                        & ~decay[i, known_low - decay_y:known_high - decay_y, j]
+                to_clear = np.flatnonzero(~is_air)
+                if not len(to_clear):
+                    continue
+                low, high = low + int(to_clear[0]), low + int(to_clear[-1])
+            spans[(z, low, high)].append(x)
+
+        # Merge the columns into runs along x, then the identical runs along z
+        runs = defaultdict(list)
+        for (z, low, high), xs in spans.items():
+            for first_x, last_x in self.__merge_runs(xs, FILL_LIMIT // (high - low + 1)):
+                runs[(first_x, last_x, low, high)].append(z)
+
+        blocks_cleared = 0
+        for (first_x, last_x, low, high), zs in runs.items():
+            column_volume = (last_x - first_x + 1) * (high - low + 1)
+            for first_z, last_z in self.__merge_runs(zs, FILL_LIMIT // column_volume):
+                self.editor.runCommand(f"fill {first_x} {low} {first_z} {last_x} {high} {last_z} air",
+                                       syncWithBuffer=True)
+                blocks_cleared += column_volume * (last_z - first_z + 1)
+                if known_air:
+                    # The fill goes around the editor buffer, the cleared blocks are known to be air from now on.
+                    # Blocks placed there later are still decayed in the editor, and cleared again
+                    (i1, j1), (i2, j2) = self.coord_absolute_to_relative(first_x, first_z), \
+                        self.coord_absolute_to_relative(last_x, last_z)
+                    volume[i1:i2 + 1, max(low - volume_y, 0):max(high - volume_y + 1, 0), j1:j2 + 1] = True
+        return blocks_cleared
+
+    @report.timed('build_roads')
+    def build_roads(self, floor_pattern: dict[str, dict[str, float]], slab_pattern=None, full=False) -> int:
+        """Place the road cells added or reclassified since the last call, or every road cell if full
+
+        Return the amount of blocks sent to the editor, also counted in the build_roads phase of the run report"""
         # self.equalize_roads()
+        if full:
+            self.__pending_road_columns = set(self.all_roads)
+            self.__pending_roads = {road for key in self.roads_infos for road in self.roads_infos[key]}
+        blocks_sent = 0
 
         # clean above roads
-        for road in self.all_roads:
-            for i in range(1, 20):
-                coordinates = increase_y(road, i)
-
-                # Check for building collision here
-                if self.build_area.contains(coordinates) and self.occupation_map[self.coord_absolute_to_relative(coordinates[0], coordinates[2])] == 1:
-                    self.editor.placeBlock(coordinates, Block("air"))
+        blocks_cleared = self.__clear_above_roads(self.__pending_road_columns)
+        blocks_sent += blocks_cleared
 
         # place blocks
         for key in self.roads_infos.keys():
-            for road in self.roads_infos[key]:
+            for road in self.__pending_roads:
+                if road not in self.roads_infos[key]:
+                    continue
                 coord = self.coord2d_to_ground_coord(*road)
                 # Default : place a block
                 chose_pattern = floor_pattern
@@ -386,3 +615,10 @@ class PlacementMap:
                                             k=1, weights=list(chose_pattern[key].values()))[0]
                 the_blocks = Block(block_str)
                 self.editor.placeBlock(coord, the_blocks)
+                blocks_sent += 1
+
+        self.__pending_road_columns = set()
+        self.__pending_roads = set()
+        report.count('build_roads', blocks_sent=blocks_sent, blocks_cleared=blocks_cleared,
+                     road_cells=blocks_sent - blocks_cleared)
+        return blocks_sent
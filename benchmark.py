@@ -0,0 +1,241 @@
+"""Time the planning stages on synthetic terrains, without a server
+
+python benchmark.py                        run every terrain at every size and compare to the stored baseline
+python benchmark.py --sizes 128 256        only some sizes
+python benchmark.py --no-memory            skip the slow peak memory measurement
+python benchmark.py --repeats 5            time every stage 5 times and keep the median
+python benchmark.py --save-baseline        store the results as the new baseline
+
+Times depend on the machine, the stored baseline is only meaningful on the machine that recorded it.
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import random
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import numpy as np
+from gdpc import Block, Box
+
+from PlacementMap import PlacementMap, NoValidPositionException
+from blob_expand import blob_expand
+from castle_geo import Castle, CastleRing, gradiantPlacer, placeGradient
+from geometry_templates import tower_wall_template, translate
+from offline_editor import OfflineEditor
+
+BASELINE_PATH = Path(__file__).with_name("benchmark_baseline.json")
+SIZES = [128, 256, 512, 1024]
+SEA_LEVEL = 62
+# A stage is reported as a regression when it is this much slower than its baseline, and by at least this many
+# seconds as the shortest stages are mostly noise
+REGRESSION_RATIO = 1.25
+REGRESSION_SECONDS = .05
+# Times are the median of this many runs, and are compared as if they lasted at least MIN_SECONDS
+REPEATS = 3
+MIN_SECONDS = .01
+
+
+def value_noise(size, cell_size, rng: np.random.Generator) -> np.ndarray:
+    """Bilinear interpolation of a random grid, values in [0, 1]"""
+    cells = size // cell_size + 2
+    grid = rng.random((cells, cells))
+    position = np.arange(size) / cell_size
+    low = position.astype(int)
+    t = position - low
+    rows = grid[low] * (1 - t)[:, np.newaxis] + grid[low + 1] * t[:, np.newaxis]
+    return rows[:, low] * (1 - t) + rows[:, low + 1] * t
+
+
+def make_terrain(kind, size, seed=0) -> tuple[np.ndarray, np.ndarray]:
+    """Return the (heightmap, dry mask) of a synthetic terrain"""
+    rng = np.random.default_rng(seed)
+    if kind == "flat":
+        heights = np.full((size, size), 70.)
+    elif kind == "noisy":
+        heights = 70 + 6 * value_noise(size, 32, rng) + rng.integers(0, 3, (size, size))
+    elif kind == "mountainous":
+        heights = 70 + sum(amplitude * value_noise(size, cell_size, rng)
+                           for amplitude, cell_size in [(80, 128), (25, 32), (6, 8)])
+    elif kind == "water":
+        heights = 50 + 25 * value_noise(size, 64, rng) + 3 * value_noise(size, 8, rng)
+    else:
+        raise ValueError(f"Unknown terrain {kind}")
+    heights = heights.astype(int)
+    dry = heights > SEA_LEVEL
+    heights[~dry] = SEA_LEVEL
+    return heights, dry
+
+
+TERRAINS = ["flat", "noisy", "mountainous", "water"]
+
+
+def make_placement_map(terrain) -> PlacementMap:
+    heights, dry = terrain
+    build_area = Box((0, -64, 0), (heights.shape[0], 384, heights.shape[1]))
+    return PlacementMap(OfflineEditor(build_area), terrain=(heights.copy(), dry))
+
+
+def stage_variance(terrain):
+    placement_map = make_placement_map(terrain)
+    return lambda: placement_map.compute_variance_map(5, 3)
+
+
+def stage_build_coordinates(terrain):
+    placement_map = make_placement_map(terrain)
+    radius = min(70, terrain[0].shape[0] // 4)
+
+    def run():
+        try:
+            return placement_map.get_build_coordinates_2d(radius, allow_next_to_occupied_zone=True, apply_bonus=True,
+                                                          min_score=.01, flatness_factor=3, height_factor=.5,
+                                                          centerness_factor=1.3, sampling=15)
+        except NoValidPositionException:
+            return None
+    return run
+
+
+def stage_blob_expand(terrain):
+    placement_map = make_placement_map(terrain)
+    size = terrain[0].shape[0]
+    return lambda: blob_expand(placement_map.build_area, placement_map.height_map, (size // 2, size // 2),
+                               max_distance=size // 4, max_rel_diff=1, max_abs_diff=15)
+
+
+def stage_fill_graph(terrain):
+    placement_map = make_placement_map(terrain)
+    return placement_map.fill_graph
+
+
+def stage_compute_roads(terrain):
+    placement_map = make_placement_map(terrain)
+    placement_map.fill_graph()
+    size = terrain[0].shape[0]
+    ends = [(0, 0), (size - 1, 0), (0, size - 1), (size - 1, size - 1)]
+    return lambda: [placement_map.compute_roads((size // 2, size // 2), end) for end in ends]
+
+
+def stage_build_tower_ring(terrain):
+    placement_map = make_placement_map(terrain)
+    size = terrain[0].shape[0]
+    radius = min(70, size // 4)
+    center = (size // 2, size // 2)
+    castle = Castle(center, radius, 1, placement_map)
+    castle.compute_territory_field([radius])
+    placer = placement_map.occupy_on_place(gradiantPlacer(placement_map.editor, [Block("stone"), Block("andesite")]))
+    ring = CastleRing(castle, center, radius, 8, True, placement_map.coord2d_to_ground_coord, placement_map.editor,
+                      lambda: 25, 9, lambda tower_height: tower_height // 2, 4, placer, placer, placer, placement_map)
+    return ring.build_tower_ring
+
+
+def stage_place_gradient(terrain):
+    size = terrain[0].shape[0]
+    editor = OfflineEditor(Box((0, 0, 0), (size, 64, size)))
+    # The wall of a tower as wide as half of the build area
+    coords = translate(tower_wall_template(size // 2, 32), (size // 2, 16, size // 2))
+    blocks = [Block(name) for name in ["blackstone", "basalt", "deepslate", "tuff", "andesite", "diorite"]]
+    return lambda: placeGradient(editor, coords, 40, 16, blocks, np.random.default_rng(0))
+
+
+STAGES = {
+    "compute_variance_map": stage_variance,
+    "get_build_coordinates_2d": stage_build_coordinates,
+    "blob_expand": stage_blob_expand,
+    "fill_graph": stage_fill_graph,
+    "compute_roads": stage_compute_roads,
+    "build_tower_ring": stage_build_tower_ring,
+    "placeGradient": stage_place_gradient,
+}
+
+
+def measure(stage, terrain, memory=True, repeats=REPEATS) -> dict[str, float]:
+    """Time repeats runs of the stage, each from a fresh setup, then run it again to measure its peak memory
+
+    The time is the median of the runs. Tracing the memory makes the run much slower, it is not part of the time."""
+    # The generation prints its progress
+    with redirect_stdout(io.StringIO()):
+        times = []
+        for _ in range(repeats):
+            random.seed(0)
+            run = stage(terrain)
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        seconds = float(np.median(times))
+        if not memory:
+            return {"seconds": seconds}
+
+        random.seed(0)
+        run = stage(terrain)
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"seconds": seconds, "peak_mib": peak / 2 ** 20}
+
+
+def run_benchmarks(sizes, terrains, stages, memory=True, repeats=REPEATS) -> dict[str, dict[str, float]]:
+    results = {}
+    for size in sizes:
+        for kind in terrains:
+            terrain = make_terrain(kind, size)
+            for name in stages:
+                key = f"{kind}/{size}/{name}"
+                results[key] = measure(STAGES[name], terrain, memory, repeats)
+                peak = f"{results[key]['peak_mib']:>9.1f} MiB" if memory else ""
+                print(f"{key:<45} {results[key]['seconds']:>9.3f}s {peak}", flush=True)
+    return results
+
+
+def compare(results, baseline) -> list[str]:
+    """Print the ratio of every result to its baseline and return the keys of the regressions"""
+    regressions = []
+    print("\nCompared to the baseline:")
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = max(result["seconds"], MIN_SECONDS) / max(baseline[key]["seconds"], MIN_SECONDS)
+        flag = ""
+        if ratio > REGRESSION_RATIO and result["seconds"] - baseline[key]["seconds"] > REGRESSION_SECONDS:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        memory = ""
+        if "peak_mib" in result and "peak_mib" in baseline[key]:
+            memory = f"  x{result['peak_mib'] / max(baseline[key]['peak_mib'], 1e-6):>6.2f} memory"
+        print(f"{key:<45} x{ratio:>6.2f} time{memory}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--terrains", nargs="+", default=TERRAINS, choices=TERRAINS)
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--no-memory", action="store_true", help="only measure the time, much faster")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="timed runs per stage, the median is kept")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.terrains, args.stages, not args.no_memory, args.repeats)
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if args.save_baseline:
+        # A time only run keeps the memory of the previous baseline
+        for key, result in results.items():
+            baseline[key] = {**baseline.get(key, {}), **result}
+        args.baseline.write_text(json.dumps(baseline, indent=1, sort_keys=True))
+        print(f"Baseline saved to {args.baseline}")
+    elif baseline:
+        regressions = compare(results, baseline)
+        print(f"\n{len(regressions)} regression(s)")
+    else:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to store one")
+
+
+if __name__ == '__main__':
+    main()
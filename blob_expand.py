@@ -4,10 +4,14 @@ import math
 import random
 from typing import Any
 
+import numpy as np
+
+from instrumentation import report
+
 
 class CoordExplore:
     def __hash__(self) -> int:
-        return int(self.x * 7 + self.z * 17)
+        return hash((self.x, self.z))
 
     def __eq__(self, other) -> bool:
         return self.x == other.x and self.z == other.z
@@ -42,34 +46,109 @@ class CoordExplore:
         return self.x, y, self.z
 
 
+@report.timed('blob_expand')
+def expand_field(hmap, start: tuple[int, int], thresholds, max_rel_diff=1, max_abs_diff=5,
+                 excluded_mask=None) -> np.ndarray:
+    """Return, for every cell of hmap, the smallest of the distance thresholds for which the cell is in the region
+    grown from start (relative indexes), or inf if it never is
+
+    A cell joins the region when a 4-neighbor in the region differs from it by at most max_rel_diff, it differs from
+    the start by at most max_abs_diff, it is at most the threshold away from the start and it is not excluded.
+    The regions are grown one whole frontier at a time, each threshold resuming from the region of the previous one,
+    so all of them cost about as much as the largest one."""
+    field = np.full(hmap.shape, np.inf)
+    si, sj = start
+    thresholds = sorted(thresholds)
+    if not thresholds or not (0 <= si < hmap.shape[0] and 0 <= sj < hmap.shape[1]):
+        return field
+
+    reach = int(thresholds[-1])
+    i0, i1 = max(si - reach, 0), min(si + reach + 1, hmap.shape[0])
+    j0, j1 = max(sj - reach, 0), min(sj + reach + 1, hmap.shape[1])
+    heights = np.asarray(hmap[i0:i1, j0:j1], dtype=np.int64)
+    ii, jj = np.ogrid[i0:i1, j0:j1]
+
+    squared_distance = (ii - si) ** 2 + (jj - sj) ** 2
+    allowed = np.abs(heights - heights[si - i0, sj - j0]) <= max_abs_diff
+    if excluded_mask is not None:
+        allowed &= ~excluded_mask[i0:i1, j0:j1]
+    # Edges between (i, j) and (i + 1, j), and between (i, j) and (i, j + 1)
+    down_ok = np.abs(np.diff(heights, axis=0)) <= max_rel_diff
+    right_ok = np.abs(np.diff(heights, axis=1)) <= max_rel_diff
+
+    window_field = field[i0:i1, j0:j1]
+    region = np.zeros(heights.shape, dtype=bool)
+    region[si - i0, sj - j0] = True
+    grown = np.empty_like(region)
+    for threshold in thresholds:
+        allowed_here = allowed & (squared_distance <= threshold ** 2)
+        frontier = region.copy()
+        while frontier.any():
+            grown[:] = False
+            grown[1:, :] |= frontier[:-1, :] & down_ok
+            grown[:-1, :] |= frontier[1:, :] & down_ok
+            grown[:, 1:] |= frontier[:, :-1] & right_ok
+            grown[:, :-1] |= frontier[:, 1:] & right_ok
+            frontier = grown & allowed_here & ~region
+            region |= frontier
+        window_field[region & np.isinf(window_field)] = threshold
+
+    report.count('blob_expand', cells=int(np.count_nonzero(region)))
+    return field
+
+
+def expand_mask(hmap, start: tuple[int, int], max_rel_diff=1, max_abs_diff=5, max_distance=5,
+                excluded_mask=None) -> np.ndarray:
+    """Return the boolean mask, over hmap, of the region grown from start (relative indexes), see expand_field"""
+    return np.isfinite(expand_field(hmap, start, [max_distance], max_rel_diff, max_abs_diff, excluded_mask))
+
+
+def mask_to_coords(mask, build_area) -> tuple[np.ndarray, np.ndarray]:
+    """Return the absolute x and z coordinates of the cells of a mask over the build area"""
+    i, j = np.nonzero(mask)
+    return i + build_area.begin[0], j + build_area.begin[2]
+
+
+def blob_expand_mask(build_area, hmap, start: tuple[int, int], max_rel_diff=1, max_abs_diff=5, max_distance=5,
+                     excluded_mask=None, return_coords=False):
+    """Same as blob_expand with a start in absolute coordinates, but return a mask over hmap, and the absolute
+    coordinates of its cells if return_coords"""
+    mask = expand_mask(hmap, (start[0] - build_area.begin[0], start[1] - build_area.begin[2]),
+                       max_rel_diff, max_abs_diff, max_distance, excluded_mask)
+    if return_coords:
+        return mask, mask_to_coords(mask, build_area)
+    return mask
+
+
+def blob_expand_field(build_area, hmap, start: tuple[int, int], thresholds, max_rel_diff=1, max_abs_diff=5,
+                      excluded_mask=None) -> np.ndarray:
+    """Same as expand_field with a start in absolute coordinates"""
+    return expand_field(hmap, (start[0] - build_area.begin[0], start[1] - build_area.begin[2]), thresholds,
+                        max_rel_diff, max_abs_diff, excluded_mask)
+
+
 def blob_expand(build_area, hmap, start: tuple[int, int], max_rel_diff=1, max_abs_diff=5, max_distance=5,
                 excluded_coords_set=None) -> list[
     CoordExplore | Any]:
+    """List the coordinates of the region grown from start, see expand_mask
+
+    The cells of excluded_coords_set are not explored, and the region is added to it."""
+    excluded_mask = None
+    if excluded_coords_set:
+        excluded_mask = np.zeros(hmap.shape, dtype=bool)
+        for coord in excluded_coords_set:
+            i, j = coord.to_relative
+            if 0 <= i < hmap.shape[0] and 0 <= j < hmap.shape[1]:
+                excluded_mask[i, j] = True
+
     start = CoordExplore(start[0], start[1], build_area)
-    blob = [start]
-    to_explore = [start]
-    explored = {start}
+    mask = expand_mask(hmap, start.to_relative, max_rel_diff, max_abs_diff, max_distance, excluded_mask)
+    if mask.any():
+        mask[start.to_relative] = False
+    blob = [start] + [CoordExplore(x, z, build_area) for x, z in zip(*map(np.ndarray.tolist,
+                                                                         mask_to_coords(mask, build_area)))]
     if excluded_coords_set is not None:
-        explored = excluded_coords_set
-        explored.add(start)
-
-    while len(to_explore) > 0:
-        current = to_explore.pop()
-        blob.append(current)
-        explored.add(current)
-        for direction in [(1, 0), (0, 1), (-1, 0), (0, -1)]:
-            neighbor = current + direction
-            rel_cur = current.to_relative
-            rel_neigb = neighbor.to_relative
-            if neighbor not in explored \
-                    and neighbor.distance_to(start) <= max_distance \
-                    and 0 <= rel_cur[0] < hmap.shape[0] and 0 <= rel_cur[1] < hmap.shape[1] \
-                    and 0 <= rel_neigb[0] < hmap.shape[0] and 0 <= rel_neigb[1] < hmap.shape[1] \
-                    and abs(hmap[rel_cur] - hmap[rel_neigb]) <= max_rel_diff \
-                    and abs(hmap[rel_neigb] - hmap[start.to_relative]) <= max_abs_diff:
-                explored.add(neighbor)
-                to_explore.append(neighbor)
-
+        excluded_coords_set.update(blob)
     return blob
 
 
@@ -77,32 +156,66 @@ def from_angle(angle, radius, offset):
     return int(math.cos(angle) * radius + offset[0]), int(math.sin(angle) * radius + offset[1])
 
 
-def get_borders(coord_area, center, point_amount, max_radius):
+def _contains_many(coord_area, xs, zs) -> np.ndarray:
+    if hasattr(coord_area, 'contains_many'):
+        return coord_area.contains_many(xs, zs)
+    return np.array([(x, z) in coord_area for x, z in zip(xs.ravel().tolist(), zs.ravel().tolist())],
+                    dtype=bool).reshape(xs.shape)
+
+
+def ray_coords(center, point_amount, radii):
+    """Return the (point_amount, len(radii)) x and z coordinates of evenly spaced rays from center, sampled at radii,
+    rounded like from_angle"""
     angle_offset = random.random() * 2 * math.pi
-    for i in range(point_amount):
-        angle = i * 2 * math.pi / point_amount + angle_offset
-        # raycast
-        radius = 0
-        coord = from_angle(angle, radius, center)
-        radius += 1
-        next_coord = from_angle(angle, radius, center)
-        while next_coord in coord_area and radius <= max_radius:
-            radius += 1
-            coord = next_coord
-            next_coord = from_angle(angle, radius, center)
+    angles = np.arange(point_amount) * 2 * math.pi / point_amount + angle_offset
+    radii = np.asarray(radii, dtype=np.float64)
+    xs = (np.cos(angles)[:, np.newaxis] * radii + center[0]).astype(np.int64)
+    zs = (np.sin(angles)[:, np.newaxis] * radii + center[1]).astype(np.int64)
+    return xs, zs
 
-        yield coord
+
+def get_borders(coord_area, center, point_amount, max_radius):
+    """Yield, for each ray, the last coordinate in coord_area when walking from the center outward"""
+    radii = np.arange(0, math.floor(max_radius) + 2)
+    xs, zs = ray_coords(center, point_amount, radii)
+    # A ray stops on its first coordinate outside the area, or when exceeding max_radius
+    outside = ~_contains_many(coord_area, xs, zs)
+    outside[:, 0] = False
+    outside[:, -1] = True
+    stops = np.argmax(outside, axis=1) - 1
+    rays = np.arange(point_amount)
+    yield from zip(xs[rays, stops].tolist(), zs[rays, stops].tolist())
 
 
 def get_borders_from_outside(coord_area, center, point_amount, max_radius):
-    angle_offset = random.random() * 2 * math.pi
-    for i in range(point_amount):
-        angle = i * 2 * math.pi / point_amount + angle_offset
-        # raycast from outside
-        radius = max_radius
-        coord = from_angle(angle, radius, center)
-        while coord not in coord_area and radius > 0:
-            radius -= 1
-            coord = from_angle(angle, radius, center)
-
-        yield coord
+    """Yield, for each ray, the first coordinate in coord_area when walking from max_radius inward"""
+    radii = max_radius - np.arange(0, math.ceil(max_radius) + 1)
+    xs, zs = ray_coords(center, point_amount, radii)
+    # A ray stops on its first coordinate inside the area, or once its radius is not positive anymore
+    inside = _contains_many(coord_area, xs, zs)
+    inside[:, -1] = True
+    stops = np.argmax(inside, axis=1)
+    rays = np.arange(point_amount)
+    yield from zip(xs[rays, stops].tolist(), zs[rays, stops].tolist())
+
+
+def boundary_mask(mask) -> np.ndarray:
+    """Return the cells of the mask having a 4-neighbor outside of it, or on the edge of the array"""
+    interior = mask.copy()
+    interior[1:, :] &= mask[:-1, :]
+    interior[:-1, :] &= mask[1:, :]
+    interior[:, 1:] &= mask[:, :-1]
+    interior[:, :-1] &= mask[:, 1:]
+    interior[[0, -1], :] = False
+    interior[:, [0, -1]] = False
+    return mask & ~interior
+
+
+def boundary_contour(region, center=None) -> tuple[np.ndarray, np.ndarray]:
+    """Return the x and z coordinates of the boundary of a Region, sorted by angle around center if given"""
+    i, j = np.nonzero(boundary_mask(region.mask))
+    xs, zs = i + region.origin[0], j + region.origin[1]
+    if center is not None:
+        order = np.argsort(np.arctan2(zs - center[1], xs - center[0]), kind='stable')
+        xs, zs = xs[order], zs[order]
+    return xs, zs
@@ -0,0 +1,131 @@
+import random
+from numbers import Integral
+from typing import Callable
+
+from gdpc import Editor, Block
+
+import instrumentation
+from coord_batch import as_coord_batch
+from world_diff import WorldSliceBlocks
+
+
+class CoalescingEditor:
+    """Layer between the generation and an Editor keeping a single pending block per coordinate
+
+    The last write to a coordinate wins, unless a priority function is given: a write then only replaces the pending
+    block if its priority is at least as high. Pending blocks are sent to the editor on flushBuffer, in batches of
+    batch_size, and automatically once max_pending blocks are pending so that a large castle or road network is never
+    held whole in memory. Writes on both sides of such a flush are not coalesced. Every other attribute is forwarded to
+    the editor.
+
+    With skip_unchanged, pending blocks identical to the cached world slice of the editor are not sent."""
+
+    def __init__(self, editor: Editor, priority: Callable[[Block], int] | None = None, batch_size=64000,
+                 skip_unchanged=False, max_pending=256000):
+        self.editor = editor
+        self.priority = priority
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.skip_unchanged = skip_unchanged
+        self.world_blocks: WorldSliceBlocks | None = None
+        self.pending: dict[tuple[int, int, int], Block] = {}
+        self.pending_commands: list[str] = []
+        self.writes_received = 0
+        self.writes_removed = 0
+        self.blocks_planned = 0
+        self.blocks_skipped = 0
+        self.blocks_sent = 0
+
+    def __getattr__(self, name):
+        return getattr(self.editor, name)
+
+    @staticmethod
+    def __is_single_position(position) -> bool:
+        return hasattr(position, "__len__") and len(position) == 3 and isinstance(position[0], Integral)
+
+    def __write(self, position, block):
+        key = (int(position[0]), int(position[1]), int(position[2]))
+        if not isinstance(block, Block):
+            block = random.choice(block)
+        self.writes_received += 1
+        if key in self.pending:
+            self.writes_removed += 1
+            if self.priority is not None and self.priority(block) < self.priority(self.pending[key]):
+                return
+            # Keep the insertion order of the last write
+            self.pending.pop(key)
+        self.pending[key] = block
+        if len(self.pending) >= self.max_pending:
+            self.flushBuffer()
+
+    def placeBlock(self, position, block, replace=None):
+        positions = [position] if self.__is_single_position(position) else position
+        for pos in positions:
+            if replace is not None:
+                replace_ids = [replace] if isinstance(replace, str) else replace
+                if self.getBlock(pos).id not in replace_ids:
+                    continue
+            self.__write(pos, block)
+        return True
+
+    def getBlock(self, position):
+        key = (int(position[0]), int(position[1]), int(position[2]))
+        if key in self.pending:
+            return self.pending[key]
+        return self.editor.getBlock(position)
+
+    def runCommand(self, command: str, position=None, syncWithBuffer=False):
+        if syncWithBuffer:
+            # Run after the pending blocks, as the editor does with its own buffer
+            self.pending_commands.append(command if position is None else
+                                         f"execute positioned {' '.join(str(c) for c in position)} run {command}")
+            return
+        self.editor.runCommand(command, position)
+
+    def __world_blocks(self) -> WorldSliceBlocks | None:
+        world_slice = self.editor.worldSlice
+        if world_slice is None:
+            return None
+        if self.world_blocks is None or self.world_blocks.world_slice is not world_slice:
+            self.world_blocks = WorldSliceBlocks(world_slice)
+        return self.world_blocks
+
+    def __remove_unchanged(self, pending):
+        world_blocks = self.__world_blocks() if self.skip_unchanged else None
+        if world_blocks is None or not pending:
+            return pending
+        batch = as_coord_batch([position for position, _ in pending])
+        changed = world_blocks.changed_mask(batch, [block for _, block in pending], self.editor.worldSliceDecay)
+        return [pending[i] for i in changed.nonzero()[0].tolist()]
+
+    def flushBuffer(self):
+        # The wrapped editor may only record the blocks, the time and size of the sending are measured where they are
+        # sent to the server
+        with instrumentation.report.phase('coalesce') as counters:
+            pending = list(self.pending.items())
+            self.pending = {}
+            planned = len(pending)
+            pending = self.__remove_unchanged(pending)
+            self.blocks_planned += planned
+            self.blocks_skipped += planned - len(pending)
+            for start in range(0, len(pending), self.batch_size):
+                for position, block in pending[start:start + self.batch_size]:
+                    self.editor.placeBlock(position, block)
+                self.editor.flushBuffer()
+            self.blocks_sent += len(pending)
+
+            for command in self.pending_commands:
+                self.editor.runCommand(command, syncWithBuffer=True)
+            counters['commands'] += len(self.pending_commands)
+            self.pending_commands = []
+            self.editor.flushBuffer()
+            counters['blocks_planned'] += planned
+            counters['blocks_kept'] += len(pending)
+
+    def report(self) -> dict[str, int]:
+        return {'writes_received': self.writes_received,
+                'writes_removed': self.writes_removed,
+                'blocks_planned': self.blocks_planned,
+                'blocks_skipped': self.blocks_skipped,
+                'blocks_sent': self.blocks_sent,
+                'blocks_pending': len(self.pending)}
@@ -1,12 +1,18 @@
-import math
 import random
 
+import numpy as np
 from gdpc import Editor, Box, Block, geometry
 
 from PlacementMap import PlacementMap
-from blob_expand import blob_expand, get_borders_from_outside
+from coord_batch import as_coord_batch, batch_to_tuples
+from instrumentation import report
+from geometry_templates import tower_wall_template, tower_roof_template, house_wall_template, \
+    house_roof_templates, translate
+from blob_expand import blob_expand_mask, blob_expand_field, get_borders_from_outside
+from region import Region
+from spatial_index import SpatialIndex
 from utils import circle_around, increase_y, coord_scalar_mul, coords_add, \
-    coords_sub, coord_int, coord_in_area, get_distance, \
+    coords_sub, coord_int, coord_in_area, \
     coord3d_list_to_2d
 
 
@@ -18,21 +24,13 @@ class Tower:
         self.wall_fct = wall_fct
         self.roof_fct = roof_fct
 
+    def to_plan(self) -> dict:
+        return {'center': list(map(int, self.center)), 'width': self.width, 'height': self.height}
+
     def build_tower(self):
         print(":", end="")
-        self.wall_fct(geometry.cylinder(self.center, self.width, self.height, hollow=True))
-
-        def roof_shape(coord, width):
-            return list(geometry.cylinder(coord, width, 1, hollow=True))
-
-        def odd_width_generator(start_width, end=2, repeat=1):
-            for i in range(start_width, end, -2):
-                for _ in range(repeat):
-                    yield i
-
-        roof_coords = list(roof_blocks(increase_y(self.center, self.height), roof_shape,
-                                       list(odd_width_generator(self.width + 2, repeat=3))))
-        self.roof_fct(roof_coords)
+        self.wall_fct(translate(tower_wall_template(self.width, self.height), self.center))
+        self.roof_fct(translate(tower_roof_template(self.width), increase_y(self.center, self.height)))
 
 
 class CastleRing:
@@ -54,44 +52,44 @@ class CastleRing:
         self.tower_amount = tower_amount
         self.towers: list[Tower] = []
         self.gates = []
-        self.blocks = []
+        self.blocks = Region(placement_map.build_area)
         self.castle: Castle = castle
 
     def get_territory(self):
-        self.blocks = set(map(lambda coord: (coord.x, coord.z), blob_expand(self.placement_map.build_area, self.placement_map.height_map, self.center, max_distance=self.radius,
-                    max_rel_diff=1, max_abs_diff=15)))
+        if self.castle.territory_field is not None and self.radius in self.castle.territory_radii:
+            self.blocks = Region(self.placement_map.build_area, self.castle.territory_field <= self.radius)
+            return
+        self.blocks = Region(self.placement_map.build_area, blob_expand_mask(
+            self.placement_map.build_area, self.placement_map.height_map, self.center, max_distance=self.radius,
+            max_rel_diff=1, max_abs_diff=15))
 
+    @report.timed('build_tower_ring')
     def build_tower_ring(self):
         print("&", end="")
         self.get_territory()
         circle = list(get_borders_from_outside(self.blocks, self.center, self.tower_amount, self.radius))
+        base_coords = self.ground_coords(circle)
         tower_heights = []
         # Place towers
-        for x, z in circle:
-            if not self.editor.getBuildArea().contains((x, 0, z)) or (x, z) not in self.blocks:
+        for (x, z), base_coord in zip(circle, base_coords):
+            if not self.placement_map.build_area.contains((x, 0, z)) or (x, z) not in self.blocks:
                 continue
-            base_coord = self.coord2d_to_ground_coord(x, z)
 
             # Check for tower collision
             i, j = self.placement_map.coord_absolute_to_relative(x, z)
 
-            all_towers = [tower for ring in self.castle.rings for tower in ring.towers]
-
             # get nearest tower
-            if len(all_towers) > 0:
-                min_distance, nearest_tower = min([(get_distance((tower.center[0], tower.center[2]), (x, z)), tower) for tower in all_towers], key=lambda a: a[0])
-                if min_distance <= self.tower_width + nearest_tower.width:
-                    self.towers.append(nearest_tower)
-                    tower_heights.append(nearest_tower.height)
-                    print("M", end="")
-                else:
-                    tower_heights.append(self.tower_height_fun())
-                    self.towers.append(Tower(base_coord, self.tower_width, tower_heights[-1], self.wall_placer_fct,
-                                             self.roof_placer_fct))
-                    self.towers[-1].build_tower()
+            nearest = self.castle.structure_index.nearest((x, z))
+            if nearest is not None and nearest[0] <= self.tower_width + nearest[1].width:
+                nearest_tower = nearest[1]
+                self.towers.append(nearest_tower)
+                tower_heights.append(nearest_tower.height)
+                print("M", end="")
             else:
                 tower_heights.append(self.tower_height_fun())
-                self.towers.append(Tower(base_coord, self.tower_width, tower_heights[-1], self.wall_placer_fct, self.roof_placer_fct))
+                self.towers.append(Tower(base_coord, self.tower_width, tower_heights[-1], self.wall_placer_fct,
+                                         self.roof_placer_fct))
+                self.castle.structure_index.insert((base_coord[0], base_coord[2]), self.towers[-1])
                 self.towers[-1].build_tower()
 
         if self.build_rampart and tower_heights:
@@ -99,29 +97,22 @@ class CastleRing:
             wall_height = self.wall_height_fun(min(tower_heights) + 5)
             # Place walls
             tower_coords = coord3d_list_to_2d(map(lambda t: t.center, self.towers))
-            for (x1, z1), (x2, z2) in zip(tower_coords, tower_coords[1:] + [tower_coords[0]]):
-                if not (self.editor.getBuildArea().contains((x1, 0, z1)) and self.editor.getBuildArea().contains((x2, 0, z2))):
+            ground_coords = self.ground_coords(tower_coords)
+            build_area = self.placement_map.build_area
+            for (x1, z1), (x2, z2), coord1, coord2 in zip(tower_coords, tower_coords[1:] + [tower_coords[0]],
+                                                          ground_coords, ground_coords[1:] + [ground_coords[0]]):
+                if not (build_area.contains((x1, 0, z1)) and build_area.contains((x2, 0, z2))):
                     continue
-                coord1 = self.coord2d_to_ground_coord(x1, z1)
-                coord2 = self.coord2d_to_ground_coord(x2, z2)
-
-                rampart_line = list(geometry.line3D(coord_int(coord1), coord_int(coord2), width=self.wall_width))
-
-                # Build dict with max Y's
-                rampart_height = {(coord[0], coord[2]): 300 for coord in rampart_line}
-                for coord in rampart_line:
-                    if coord[1] < rampart_height[(coord[0], coord[2])]:
-                        rampart_height[(coord[0], coord[2])] = coord[1]
-
-                rampart_biggest_ys = [(index[0], rampart_height[index], index[1]) for index in rampart_height.keys()]
 
-                rampart_blocks = [increase_y(coord, i) for i in range(wall_height) for coord in
-                                  rampart_biggest_ys] + rampart_line
-
-                self.rampart_placer_fct(rampart_blocks)
+                self.rampart_placer_fct(extrude_wall(coord_int(coord1), coord_int(coord2), self.wall_width,
+                                                     wall_height))
 
         self.compute_gates()
 
+    def ground_coords(self, coords2d) -> list[tuple[int, int, int]]:
+        """Ground coordinates of every (x, z), looked up in the height map at once"""
+        coords2d = np.asarray(coords2d, dtype=np.int64).reshape((-1, 2))
+        return batch_to_tuples(self.placement_map.coord2d_to_ground_coords(coords2d[:, 0], coords2d[:, 1]))
 
     def compute_gates(self):
         if not len(self.towers):
@@ -129,6 +120,10 @@ class CastleRing:
         for t1, t2 in zip(self.towers, self.towers[1:] + [self.towers[0]]):
             self.gates.append(coord_int(coords_add(coord_scalar_mul(coords_sub(t2.center, t1.center), .5), t1.center)))
 
+    def to_plan(self) -> dict:
+        return {'center': list(map(int, self.center)), 'radius': self.radius,
+                'towers': [tower.to_plan() for tower in self.towers], 'gates': [list(map(int, gate)) for gate in self.gates]}
+
     def __contains__(self, coord):
         return coord_in_area(coord, self.center, self.radius)
 
@@ -140,6 +135,17 @@ class Castle:
         self.radius = radius
         self.ring_amount = ring_amount
         self.rings: list[CastleRing] = []
+        self.territory_radii = []
+        self.territory_field = None
+        # Every structure of the castle, to find the nearest one to a new structure
+        self.structure_index = SpatialIndex()
+
+    def compute_territory_field(self, radii):
+        """Grow the territories of every ring radius at once, a ring territory is then the cells of the field at most
+        its radius"""
+        self.territory_radii = list(radii)
+        self.territory_field = blob_expand_field(self.placement_map.build_area, self.placement_map.height_map,
+                                                 self.center, self.territory_radii, max_rel_diff=1, max_abs_diff=15)
 
     def build_castle(self, editor: Editor, coord2d_to_ground_coord, wall_placer_fct, roof_placer_fct,
                      rampart_placer_fct):
@@ -177,6 +183,7 @@ class Castle:
         wall_height_fun = lambda t_height: variation_clamped_around(min_height - 2, t_height, int(t_height / 2), 5)
         wall_width_fun = lambda t_width: variation_clamped_around(2, t_width, int(t_width / 2), 3)
 
+        self.compute_territory_field([(i + 1) * (self.radius / self.ring_amount) for i in range(self.ring_amount)])
         for i in range(self.ring_amount):
             ring_radius = (i + 1) * (self.radius / self.ring_amount)
 
@@ -186,40 +193,56 @@ class Castle:
                                          tower_height_fun_generator(i), tower_width, wall_height_fun, wall_width_fun(tower_width),
                                          wall_placer_fct, roof_placer_fct, rampart_placer_fct, self.placement_map))
             self.rings[-1].build_tower_ring()
+            # Lets the ring be sent while the next one is built
+            self.placement_map.editor.flushBuffer()
 
-        self.placement_map.editor.flushBuffer()
         print("\nCastle generation over")
 
+    def to_plan(self) -> dict:
+        return {'center': list(map(int, self.center)), 'radius': self.radius,
+                'rings': [ring.to_plan() for ring in self.rings]}
+
     def __contains__(self, coord):
         return coord_in_area(coord, self.center, self.radius)
 
 
 def gradiantPlacer(editor, block_pattern: list[Block]):
     def placer(iterator):
-        block_list = list(iterator)
-        if not len(block_list):
+        batch = as_coord_batch(iterator)
+        if not len(batch):
             return
-        y_coords = list(map(lambda b: b[1], block_list))
-        placeGradient(editor, block_list, min(y_coords), len(set(y_coords)), block_pattern)
+        y_coords = batch[:, 1]
+        placeGradient(editor, batch, int(y_coords.min()), len(np.unique(y_coords)), block_pattern)
 
     return placer
 
 
-def placeGradient(editor: Editor, iterator, comp, size, blocks: list[Block]):
-    block_amount = len(blocks)
+def gradient_indices(coords: np.ndarray, comp, size, block_amount, rng: np.random.Generator) -> np.ndarray:
+    """Return the palette index of every (x, y, z) row of coords
+
+    A block takes the first palette level whose sinusoidal band, along x + z, is above its height from comp."""
     thickness = size / block_amount
+    diagonal = (coords[:, 0] + coords[:, 2]).astype(np.float64)[:, np.newaxis]
+    levels = np.arange(block_amount)
+    frequencies = rng.integers(1, 6, size=(len(coords), block_amount))
+    bands = np.sin(diagonal * frequencies * 10) * np.sin(diagonal * 100) * thickness + levels * thickness + 5
+    above = bands > (coords[:, 1] - comp)[:, np.newaxis]
+    return np.where(above.any(axis=1), above.argmax(axis=1), block_amount - 1)
 
-    fun = lambda x, idx: math.sin(x * random.randint(1, 5) * 10) * math.sin(x * 100) * thickness + (idx * thickness) + 5
 
-    def get_block(position):
-        for i in range(block_amount):
-            if fun(position[0] + position[2], i) > position[1] - comp:
-                return i
-        return block_amount - 1
+@report.timed('placeGradient')
+def placeGradient(editor: Editor, iterator, comp, size, blocks: list[Block], rng: np.random.Generator | None = None):
+    if rng is None:
+        # Follow the seed of the random module
+        rng = np.random.default_rng(random.getrandbits(64))
+    coords = as_coord_batch(iterator)
+    if not len(coords):
+        return
+    indices = gradient_indices(coords, comp, size, len(blocks), rng)
+    report.count('placeGradient', blocks=len(coords))
 
-    for position in iterator:
-        i = get_block(position)
-        editor.placeBlock(position, blocks[i])
+    for i in np.unique(indices).tolist():
+        editor.placeBlock(coords[indices == i].tolist(), blocks[i])
 
 
 def placeGradientBox(editor: Editor, box: Box, blocks: list[Block]) -> None:
@@ -232,23 +255,46 @@ def roof_blocks(center, shape_function, widths):
             yield coord
 
 
+def extrude_wall(coord1, coord2, width, height):
+    """Return the wall line between two coordinates with each of its columns extruded from its lowest block over
+    height blocks, without duplicates"""
+    line = as_coord_batch(geometry.line3D(coord1, coord2, width=width))
+    if not len(line):
+        return line
+    # Lowest y of each (x, z) column: first row of each column once sorted by x, z then y
+    line = line[np.lexsort((line[:, 1], line[:, 2], line[:, 0]))]
+    column_starts = np.ones(len(line), dtype=bool)
+    column_starts[1:] = np.any(line[1:, [0, 2]] != line[:-1, [0, 2]], axis=1)
+    bases = line[column_starts]
+
+    extruded = np.repeat(bases, height, axis=0)
+    extruded[:, 1] += np.tile(np.arange(height, dtype=np.int32), len(bases))
+    return as_coord_batch(np.unique(np.concatenate((extruded, line)), axis=0))
+
+
 def house_builder_generator(house_height, house_size, wall_placer, roof_placer):
     def house_builder(center):
-        wall_placer(geometry.cylinder(center, diameters=house_size, length=house_height, tube=True))
-        for y, i in enumerate(range(house_size, 3, -2), start=house_height):
-            roof_placer(geometry.cylinder(increase_y(center, y), diameters=i, length=1))
+        wall_placer(translate(house_wall_template(house_size, house_height), center))
+        for roof_layer in house_roof_templates(house_size, house_height):
+            roof_placer(translate(roof_layer, center))
     return house_builder
 
 
 def build_habitation_ring(ring_center, ring_radius, coord2d_to_ground_coord, editor, house_amount,
-                     house_fun):
+                     house_fun, structure_index: SpatialIndex | None = None, spacing=0):
     circle = list(circle_around(ring_center, ring_radius, house_amount))
+    build_area = editor.getBuildArea()
     # Place habitations
     for x, z in circle:
-        if not editor.getBuildArea().contains((x, 0, z)):
+        if not build_area.contains((x, 0, z)):
+            continue
+        # Skip the houses too close to another structure
+        if structure_index is not None and structure_index.within((x, z), spacing):
             continue
         base_coord = coord2d_to_ground_coord(x, z)
         house_fun(base_coord)
+        if structure_index is not None:
+            structure_index.insert((x, z), base_coord)
 
 
 
@@ -0,0 +1,36 @@
+import numpy as np
+
+# A batch of block coordinates: a C-contiguous int32 array of shape (N, 3), one (x, y, z) per row
+CoordBatch = np.ndarray
+
+
+def as_coord_batch(coords) -> CoordBatch:
+    """Return coords as a CoordBatch, without copying when it already is one
+
+    Accepts any iterable of (x, y, z), such as a list of tuples or a gdpc geometry generator."""
+    if isinstance(coords, np.ndarray) and coords.dtype == np.int32 and coords.ndim == 2 \
+            and coords.shape[1] == 3 and coords.flags['C_CONTIGUOUS']:
+        return coords
+    if not isinstance(coords, np.ndarray):
+        coords = [tuple(coord) for coord in coords]
+    return np.ascontiguousarray(np.asarray(coords, dtype=np.int32).reshape((-1, 3)))
+
+
+def as_position_batch(position) -> CoordBatch:
+    """Return a single (x, y, z), or any iterable of them as gdpc placeBlock accepts, as a CoordBatch"""
+    if not hasattr(position, '__len__'):
+        position = list(position)
+    if len(position) == 3 and np.isscalar(position[0]):
+        position = [position]
+    return as_coord_batch(position)
+
+
+def batch_to_tuples(batch: CoordBatch) -> list[tuple[int, int, int]]:
+    return list(map(tuple, batch.tolist()))
+
+
+def batch_in_box(batch: CoordBatch, box) -> np.ndarray:
+    """Boolean mask of the rows of the batch inside a gdpc Box"""
+    begin = np.array(tuple(box.begin), dtype=np.int64)
+    end = begin + np.array(tuple(box.size), dtype=np.int64)
+    return np.all((batch >= begin) & (batch < end), axis=1)
@@ -0,0 +1,130 @@
+import io
+import random
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from gdpc import Box
+
+import territory
+from PlacementMap import PlacementMap
+from instrumentation import report
+from offline_editor import OfflineEditor
+from region import Region
+
+# Terrain of the build area, attached once by every worker process
+_worker_terrain: dict = {}
+
+
+class SharedTerrain:
+    """Copy of the heightmap and occupation map in shared memory, for the workers to read without pickling them"""
+
+    def __init__(self, height_map: np.ndarray, occupation_map: np.ndarray):
+        self.memories = []
+        self.description = []
+        for array in (height_map, occupation_map):
+            array = np.ascontiguousarray(array)
+            memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=memory.buf)[...] = array
+            self.memories.append(memory)
+            self.description.append((memory.name, array.shape, array.dtype.str))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+
+
+def _attach_terrain(description, build_area):
+    memories = [SharedMemory(name=name) for name, _, _ in description]
+    arrays = []
+    for memory, (_, shape, dtype) in zip(memories, description):
+        array = np.ndarray(shape, np.dtype(dtype), buffer=memory.buf)
+        array.setflags(write=False)
+        arrays.append(array)
+    _worker_terrain.update(memories=memories, height_map=arrays[0], occupation_map=arrays[1],
+                           build_area=Box(*build_area))
+
+
+def plan_district(task) -> dict:
+    """Plan the castle and roads of a district on a private copy of the placement map, recording the blocks
+
+    Run in a worker process, return what the main process needs to merge the district into its own placement map."""
+    center, radius, seed, builder_factory, road_amount, road_waves = task
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    report.reset()
+
+    editor = OfflineEditor(_worker_terrain['build_area'], apply_fill=False)
+    initially_free = _worker_terrain['occupation_map'] != 0
+    placement_map = PlacementMap(editor, terrain=(_worker_terrain['height_map'], initially_free))
+    # Progress output of several workers would be interleaved
+    with redirect_stdout(io.StringIO()):
+        castle = builder_factory(editor, placement_map)(center, radius)
+        territory.generate_roads_around(placement_map, castle, center, radius * 1.5, road_amount, road_waves)
+
+    positions, ids = editor.recorded()
+    return {'positions': positions, 'ids': ids, 'palette': editor.palette, 'commands': editor.commands,
+            'occupied': np.flatnonzero(initially_free & (placement_map.occupation_map == 0)),
+            'built': np.flatnonzero(placement_map.building_map),
+            'castle': castle.to_plan(), 'roads': placement_map.roads_plan(), 'report': report.to_dict()}
+
+
+def merge_district(placement_map: PlacementMap, result):
+    """Send the blocks and commands recorded by a worker to the editor, apply its occupation updates and add its
+    roads"""
+    editor = placement_map.editor
+    order = np.argsort(result['ids'], kind='stable')
+    ids, positions = result['ids'][order], result['positions'][order]
+    bounds = np.flatnonzero(np.diff(ids)) + 1
+    for group_ids, group in zip(np.split(ids, bounds), np.split(positions, bounds)):
+        if len(group):
+            editor.placeBlock(group, result['palette'][int(group_ids[0])])
+    for command in result['commands']:
+        editor.runCommand(command, syncWithBuffer=True)
+
+    occupied = np.zeros(placement_map.occupation_map.shape, dtype=bool)
+    occupied.flat[result['occupied']] = True
+    placement_map.occupy_region(Region(placement_map.build_area, occupied))
+    placement_map.building_map.flat[result['built']] = True
+    placement_map.merge_roads_plan(result['roads'])
+    report.merge(result['report'])
+
+
+def build_territories_parallel(placement_map: PlacementMap, builder_factory, workers=None, seed=None,
+                               district_sizes=territory.DISTRICT_SIZES, road_amount=15,
+                               road_waves=None) -> list[dict]:
+    """Reserve every district, then plan each of them in its own process and merge them back in district order,
+    return the plans of the castles
+
+    builder_factory(editor, placement_map) returns the batiment builder of a district, it must be a module level
+    function so that it can be sent to the workers. Every district gets its own random seed derived from seed, so a
+    run can be reproduced whatever the amount of workers, but not by territory.build_territories where each district
+    sees the previous ones. Blocks of later districts win where districts overlap."""
+    district_centers, district_radius = territory.reserve_districts(placement_map, district_sizes)
+    territory.connect_districts(placement_map, district_centers)
+    if seed is None:
+        seed = random.getrandbits(64)
+    seeds = [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(len(district_centers))]
+    print(f"Planning {len(district_centers)} districts in parallel, seed {seed}")
+
+    build_area = placement_map.build_area
+    with SharedTerrain(placement_map.height_map, placement_map.occupation_map) as shared, \
+            ProcessPoolExecutor(workers, initializer=_attach_terrain,
+                                initargs=(shared.description, (tuple(build_area.offset), tuple(build_area.size)))) \
+            as pool:
+        tasks = [(center, radius, district_seed, builder_factory, road_amount, road_waves)
+                 for center, radius, district_seed in zip(district_centers, district_radius, seeds)]
+        castles = []
+        for result in pool.map(plan_district, tasks):
+            merge_district(placement_map, result)
+            castles.append(result['castle'])
+
+    # Roads between districts were routed by the main process
+    placement_map.build_roads(territory.ROAD_PATTERN)
+    placement_map.editor.flushBuffer()
+    return castles
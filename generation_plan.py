@@ -0,0 +1,266 @@
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import os
+import random
+from pathlib import Path
+
+import numpy as np
+from gdpc import Block
+
+from coord_batch import as_coord_batch, as_position_batch
+from instrumentation import report
+from offline_editor import FILL_COMMAND
+
+
+def terrain_fingerprint(heightmaps: dict[str, np.ndarray]) -> str:
+    """Hash of the heightmaps of the build area, enough to tell if its terrain changed"""
+    digest = hashlib.sha1()
+    for name in sorted(heightmaps):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(heightmaps[name]).tobytes())
+    return digest.hexdigest()
+
+
+# Bumped whenever the layout of the saved plans or what a seed generates changes, so that older plans are not replayed
+PLAN_FORMAT_VERSION = 1
+
+
+def generation_mode(workers=None, road_waves=None) -> str:
+    """Name of the way a run generates, runs in different modes generate different worlds for the same seed
+
+    The districts planned in parallel do not depend on the amount of workers."""
+    mode = 'sequential' if workers is None else 'parallel'
+    return mode if road_waves is None else f"{mode}-waves{road_waves}"
+
+
+def plan_key(build_area, fingerprint, seed, mode) -> str:
+    return hashlib.sha1(f"v{PLAN_FORMAT_VERSION} {tuple(build_area.begin)} {tuple(build_area.size)} {fingerprint} "
+                        f"{seed} {mode}".encode()).hexdigest()[:20]
+
+
+class GenerationPlan:
+    """Everything a generation run decided: its structures, and the blocks and commands to send, in flush batches
+
+    A batch is what the generation sent between two flushes. Emitting the plan replays the batches in order and
+    records the last one flushed, so an interrupted emission resumes after it."""
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.palette: list[Block] = []
+        self.palette_ids: dict[str, int] = {}
+        self.positions: list[np.ndarray] = []
+        self.ids: list[np.ndarray] = []
+        self.commands: list[list[str]] = []
+        self.castles: list[dict] = []
+        self.roads: dict[str, list] = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def palette_id(self, block: Block) -> int:
+        key = repr(block)
+        if key not in self.palette_ids:
+            self.palette_ids[key] = len(self.palette)
+            self.palette.append(block)
+        return self.palette_ids[key]
+
+    def add_batch(self, positions, ids, commands):
+        self.positions.append(as_coord_batch(positions))
+        self.ids.append(np.asarray(ids, dtype=np.uint16).reshape(-1))
+        self.commands.append(list(commands))
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        metadata = {'seed': self.seed, 'commands': self.commands, 'castles': self.castles, 'roads': self.roads,
+                    'palette': [{'id': b.id, 'states': b.states, 'data': b.data} for b in self.palette]}
+        sizes = [len(batch) for batch in self.positions]
+        # Write then rename, a plan is never read half written
+        temporary = path.with_name(path.name + '.tmp.npz')
+        np.savez_compressed(temporary, metadata=np.array(json.dumps(metadata)),
+                            positions=np.concatenate(self.positions) if sizes else as_coord_batch([]),
+                            ids=np.concatenate(self.ids) if sizes else np.zeros(0, dtype=np.uint16),
+                            batch_bounds=np.cumsum([0] + sizes))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            metadata = json.loads(str(data['metadata']))
+            plan = cls(metadata['seed'])
+            for block in metadata['palette']:
+                plan.palette_id(Block(block['id'], block['states'], block['data']))
+            plan.castles, plan.roads = metadata['castles'], metadata['roads']
+            bounds = data['batch_bounds'].tolist()
+            positions, ids = data['positions'], data['ids']
+            for k, commands in enumerate(metadata['commands']):
+                plan.add_batch(positions[bounds[k]:bounds[k + 1]], ids[bounds[k]:bounds[k + 1]], commands)
+        return plan
+
+    def emit(self, editor, progress_path=None) -> int:
+        """Send the batches to the editor, flushing after each of them, and return the amount of blocks sent
+
+        With a progress_path, the index of the last flushed batch is written there until the emission ends, and the
+        batches up to it are skipped, so that an interrupted emission resumes where it stopped."""
+        first = 0
+        if progress_path is not None and Path(progress_path).exists():
+            first = int(Path(progress_path).read_text()) + 1
+            print(f"Resuming emission at batch {first} of {len(self)}")
+        sent = 0
+        for k in range(first, len(self)):
+            sent += self.emit_batch(editor, k, progress_path)
+        if progress_path is not None:
+            # Only an interrupted emission resumes, a finished one is replayed from the start next time
+            Path(progress_path).unlink(missing_ok=True)
+        return sent
+
+    def request_bytes(self, k) -> int:
+        """Size of the block lines of the batch k sent to the server, one '<x> <y> <z> <block>' line per block"""
+        positions, ids = self.positions[k], self.ids[k]
+        coordinates = sum(len(f"{x} {y} {z} ") for x, y, z in positions.tolist())
+        counts = np.bincount(ids, minlength=len(self.palette))
+        return coordinates + sum(int(count) * (len(str(block)) + 1) for block, count in zip(self.palette, counts))
+
+    def emit_batch(self, editor, k, progress_path=None) -> int:
+        """Send the batch k to the editor and flush it, return its amount of blocks
+
+        Once the batch is sent, k is written to progress_path if given."""
+        with report.phase('send') as counters:
+            positions, ids = self.positions[k], self.ids[k]
+            for block_id in np.unique(ids).tolist():
+                editor.placeBlock(positions[ids == block_id], self.palette[block_id])
+            for command in self.commands[k]:
+                editor.runCommand(command, syncWithBuffer=True)
+            editor.flushBuffer()
+            if hasattr(editor, 'awaitBufferFlushes'):
+                # A multithreaded gdpc editor may still be sending the batch
+                editor.awaitBufferFlushes()
+            counters['batches'] += 1
+            counters['blocks'] += len(positions)
+            counters['commands'] += len(self.commands[k])
+            counters['bytes'] += self.request_bytes(k)
+        if progress_path is not None:
+            Path(progress_path).write_text(str(k))
+        return len(positions)
+
+
+# Methods of a gdpc Editor using its block buffer or its cached world slice, which the sender thread uses too
+LOCKED_METHODS = {'placeBlock', 'placeBlockGlobal', 'getBlock', 'getBlockGlobal', 'getBiome', 'getBiomeGlobal',
+                  'runCommand', 'runCommandGlobal', 'flushBuffer', 'loadWorldSlice', 'updateWorldSlice'}
+
+
+class PlanRecorder:
+    """Editor recording what the generation places into a plan instead of sending it
+
+    Every flush closes a batch of the plan, and calls on_batch with its index if given. Reads are forwarded to the
+    wrapped editor, those using its buffer or world slice holding lock if given, as another thread may be sending the
+    batches to it. The recorder has its own worldSliceDecay, marking the blocks of the cached world slice of the editor
+    recorded or filled since it was loaded, as the world slice does not know about them. The decay of the editor is
+    left alone, a gdpc Editor only hands out a read-only view of it."""
+
+    def __init__(self, editor, plan: GenerationPlan, on_batch=None, lock=None):
+        self.editor = editor
+        self.plan = plan
+        self.on_batch = on_batch
+        self.lock = lock
+        self.positions: list[np.ndarray] = []
+        self.ids: list[np.ndarray] = []
+        # Single blocks, as the coalescing editor sends them, are kept as tuples until the flush
+        self.single_positions: list[tuple] = []
+        self.single_ids: list[int] = []
+        self.commands: list[str] = []
+        self.__decay: np.ndarray | None = None
+        self.__decay_slice = None
+
+    def __getattr__(self, name):
+        attribute = getattr(self.editor, name)
+        if self.lock is None or name not in LOCKED_METHODS:
+            return attribute
+
+        @functools.wraps(attribute)
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attribute(*args, **kwargs)
+        return locked
+
+    @property
+    def worldSlice(self):
+        """The world slice of the editor, loaded on first use
+
+        Blocks and fills recorded before it is loaded are marked in the decay, they may not be sent yet."""
+        if self.editor.worldSlice is None:
+            with self.lock if self.lock is not None else contextlib.nullcontext():
+                self.editor.loadWorldSlice(cache=True)
+            for positions in self.plan.positions + self.positions + [as_coord_batch(self.single_positions)]:
+                self.__decay_positions(positions)
+            for command in itertools.chain(*self.plan.commands, self.commands):
+                self.__decay_fill(command)
+        return self.editor.worldSlice
+
+    @property
+    def worldSliceDecay(self) -> np.ndarray | None:
+        world_slice = self.editor.worldSlice
+        if world_slice is None:
+            return None
+        if self.__decay_slice is not world_slice:
+            self.__decay = np.zeros(tuple(world_slice.box.size), dtype=bool)
+            self.__decay_slice = world_slice
+        return self.__decay
+
+    def __decay_positions(self, positions):
+        decay = self.worldSliceDecay
+        if decay is not None and len(positions):
+            local = positions - np.array(tuple(self.editor.worldSlice.box.offset), dtype=np.int32)
+            local = local[np.all((local >= 0) & (local < np.array(decay.shape)), axis=1)]
+            decay[local[:, 0], local[:, 1], local[:, 2]] = True
+
+    def __decay_fill(self, command):
+        match = FILL_COMMAND.match(command)
+        decay = self.worldSliceDecay
+        if match is None or decay is None:
+            return
+        # The filled box changes the world behind the world slice as the recorded blocks do
+        corners = np.array([int(c) for c in match.groups()[:6]]).reshape((2, 3))
+        offset = np.array(tuple(self.editor.worldSlice.box.offset))
+        low = np.maximum(corners.min(axis=0) - offset, 0)
+        high = np.minimum(corners.max(axis=0) - offset + 1, decay.shape)
+        if np.all(low < high):
+            decay[low[0]:high[0], low[1]:high[1], low[2]:high[2]] = True
+
+    def placeBlock(self, position, block, replace=None):
+        if hasattr(position, '__len__') and len(position) == 3 and np.isscalar(position[0]):
+            self.single_positions.append(tuple(position))
+            self.single_ids.append(self.plan.palette_id(block if isinstance(block, Block) else random.choice(block)))
+            return True
+        batch = as_position_batch(position)
+        if isinstance(block, Block):
+            ids = np.full(len(batch), self.plan.palette_id(block), dtype=np.uint16)
+        else:
+            ids = np.array([self.plan.palette_id(random.choice(block)) for _ in range(len(batch))], dtype=np.uint16)
+        self.positions.append(batch)
+        self.ids.append(ids)
+        return True
+
+    def runCommand(self, command: str, position=None, syncWithBuffer=False):
+        self.commands.append(command if position is None else
+                             f"execute positioned {' '.join(str(c) for c in position)} run {command}")
+        if position is None:
+            self.__decay_fill(command)
+
+    def flushBuffer(self):
+        if self.single_positions:
+            self.positions.append(as_coord_batch(self.single_positions))
+            self.ids.append(np.array(self.single_ids, dtype=np.uint16))
+            self.single_positions, self.single_ids = [], []
+        if not self.positions and not self.commands:
+            return
+        positions = np.concatenate(self.positions) if self.positions else as_coord_batch([])
+        self.plan.add_batch(positions, np.concatenate(self.ids) if self.ids else [], self.commands)
+        self.positions, self.ids, self.commands = [], [], []
+
+        self.__decay_positions(positions)
+        if self.on_batch is not None:
+            self.on_batch(len(self.plan) - 1)
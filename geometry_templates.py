@@ -0,0 +1,49 @@
+from functools import lru_cache
+
+import numpy as np
+from gdpc import geometry
+
+from coord_batch import CoordBatch, as_coord_batch
+
+TEMPLATE_CACHE_SIZE = 256
+
+
+def _frozen(batch: CoordBatch) -> CoordBatch:
+    # Templates are shared between every structure using them
+    batch.setflags(write=False)
+    return batch
+
+
+def odd_width_generator(start_width, end=2, repeat=1):
+    for i in range(start_width, end, -2):
+        for _ in range(repeat):
+            yield i
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def tower_wall_template(width, height) -> CoordBatch:
+    return _frozen(as_coord_batch(geometry.cylinder((0, 0, 0), width, height, hollow=True)))
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def tower_roof_template(width) -> CoordBatch:
+    """Stack of hollow rings, three of each odd width from width + 2 down to 3"""
+    layers = [as_coord_batch(geometry.cylinder((0, y, 0), layer_width, 1, hollow=True))
+              for y, layer_width in enumerate(odd_width_generator(width + 2, repeat=3))]
+    return _frozen(np.concatenate(layers) if layers else as_coord_batch([]))
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def house_wall_template(house_size, house_height) -> CoordBatch:
+    return _frozen(as_coord_batch(geometry.cylinder((0, 0, 0), diameters=house_size, length=house_height, tube=True)))
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def house_roof_templates(house_size, house_height) -> tuple[CoordBatch, ...]:
+    """One template per roof layer, as the roof is placed layer by layer"""
+    return tuple(_frozen(as_coord_batch(geometry.cylinder((0, y, 0), diameters=i, length=1)))
+                 for y, i in enumerate(range(house_size, 3, -2), start=house_height))
+
+
+def translate(template: CoordBatch, origin) -> CoordBatch:
+    return template + np.array(tuple(origin), dtype=np.int32)
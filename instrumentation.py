@@ -0,0 +1,103 @@
+import cProfile
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class RunReport:
+    """Wall time, call count and counters of the generation phases
+
+    Phases can be nested, each one is timed on its own, including the phases it contains. The report can be updated
+    from several threads, the counters yielded by phase must then only be updated by the thread in that phase, other
+    threads use count."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.phases: dict[str, dict] = defaultdict(lambda: {'calls': 0, 'seconds': 0., 'counters': defaultdict(int)})
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        with self.lock:
+            counters = self.phases[name]['counters']
+        try:
+            yield counters
+        finally:
+            with self.lock:
+                self.phases[name]['calls'] += 1
+                self.phases[name]['seconds'] += time.perf_counter() - start
+
+    def reset(self):
+        with self.lock:
+            self.phases.clear()
+            self.started = time.perf_counter()
+
+    def merge(self, other: dict):
+        """Add the phases of a report made by another process, as returned by its to_dict"""
+        with self.lock:
+            for name, phase in other['phases'].items():
+                self.phases[name]['calls'] += phase['calls']
+                self.phases[name]['seconds'] += phase['seconds']
+                for counter, amount in phase['counters'].items():
+                    self.phases[name]['counters'][counter] += amount
+
+    def count(self, name, **counters):
+        with self.lock:
+            for counter, amount in counters.items():
+                self.phases[name]['counters'][counter] += amount
+
+    def timed(self, name):
+        """Decorator running the function in the given phase"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return self.__to_dict()
+
+    def __to_dict(self) -> dict:
+        return {'total_seconds': time.perf_counter() - self.started,
+                'phases': {name: {'calls': phase['calls'], 'seconds': phase['seconds'],
+                                  'counters': dict(phase['counters'])}
+                           for name, phase in self.phases.items()}}
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def summary(self) -> str:
+        lines = [f"{'phase':<20} {'calls':>7} {'seconds':>9}  counters"]
+        with self.lock:
+            phases = {name: {**phase, 'counters': dict(phase['counters'])} for name, phase in self.phases.items()}
+        for name, phase in sorted(phases.items(), key=lambda item: -item[1]['seconds']):
+            counters = ', '.join(f"{counter}={amount}" for counter, amount in phase['counters'].items())
+            lines.append(f"{name:<20} {phase['calls']:>7} {phase['seconds']:>9.3f}  {counters}")
+        return '\n'.join(lines)
+
+
+# Report of the current run, shared by every module
+report = RunReport()
+
+
+@contextmanager
+def profiled(path=None):
+    """Run the block under cProfile and dump the stats to path, do nothing without a path"""
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
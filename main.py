@@ -1,29 +1,31 @@
 from __future__ import annotations
 
+import argparse
 import random
+from pathlib import Path
 
 from gdpc import Editor, Block, geometry, Box
 
 import territory
+from block_buffer import CoalescingEditor
 from PlacementMap import PlacementMap
 from castle_geo import gradiantPlacer, Castle
+from district_pool import build_territories_parallel
+from generation_plan import GenerationPlan, PlanRecorder, generation_mode, plan_key, terrain_fingerprint
+from instrumentation import report, profiled
+from offline_editor import OfflineEditor, save_snapshot
+from pipeline import PipelinedSender
+from terrain_cache import TerrainCache, area_key, heightmap_layers, terrain_layers
 
 
-def main():
-    colors = "white, orange, magenta, light_blue, yellow, lime, pink, gray, light_gray, cyan, purple, blue, brown, " \
-             "green, red, black".split(", ")
-
-    glass_blocks = [Block(color + "_stained_glass") for color in colors]
+def castle_builder(editor, placement_map: PlacementMap):
+    """Return the batiment builder placing castles with the given editor and placement map"""
     stone_gradient = [Block("blackstone"), Block("basalt"), Block("deepslate"),
                       Block("tuff"), Block("dead_bubble_coral_block"),
                       Block("andesite"), Block("diorite"), Block("calcite")]
 
     planks = [Block(wood_type + "_planks") for wood_type in ["dark_oak", "spruce", "oak", "birch"]]
 
-    editor = Editor(buffering=True, bufferLimit=64000, multithreading=True)
-
-    placement_map = PlacementMap(editor)
-
     stone_gradiant_placer = placement_map.occupy_on_place(gradiantPlacer(editor, stone_gradient))
     planks_gradiant_placer = placement_map.occupy_on_place(gradiantPlacer(editor, planks[::-1]))
 
@@ -36,11 +38,6 @@ def main():
               "deepslate_bricks", "cracked_deepslate_bricks", "deepslate_bricks", "cracked_deepslate_bricks"],
              ["polished_blackstone", "blackstone", "polished_blackstone"]])]))
 
-    build_area = editor.getBuildArea()
-
-    debug_palette = [Block(color + "_concrete") for color in ["lime", "yellow", "red", "purple", "black"]][::-1]
-    palette_size = len(debug_palette)
-
     def batiment_builder(center, radius):
         c = Castle(center, radius, 7, placement_map)
         c.build_castle(editor, placement_map.coord2d_to_ground_coord,
@@ -48,19 +45,148 @@ def main():
                        get_rampart_function())
         return c
 
+    return batiment_builder
+
+
+def main(snapshot=None, export=None, workers=None, seed=None, plan_cache=None, terrain_cache=None,
+         send_queue=4, road_waves=None):
+    colors = "white, orange, magenta, light_blue, yellow, lime, pink, gray, light_gray, cyan, purple, blue, brown, " \
+             "green, red, black".split(", ")
+
+    glass_blocks = [Block(color + "_stained_glass") for color in colors]
+
+    if snapshot is None:
+        backend = Editor(buffering=True, bufferLimit=64000, multithreading=True)
+    else:
+        backend = OfflineEditor.from_snapshot(snapshot)
+    if seed is None:
+        seed = random.getrandbits(32)
+    print(f"Seed {seed}")
+
+    build_area = backend.getBuildArea()
+    terrain_cache = TerrainCache(terrain_cache) if terrain_cache is not None else None
+    with report.phase('terrain'):
+        layers = terrain_cache.load(backend) if terrain_cache is not None else None
+        if layers is None:
+            if backend.worldSlice is None:
+                backend.loadWorldSlice(cache=True)
+            layers = terrain_layers(backend.worldSlice)
+            if terrain_cache is not None:
+                # Before anything is sent, the layers are those of the world the fingerprint is taken from
+                terrain_cache.save(backend, layers)
+    plan_path = progress_path = resume_path = None
+    if plan_cache is not None:
+        # A partly sent plan changed the terrain, it is found again by its build area and seed
+        mode = generation_mode(workers, road_waves)
+        resume_path = Path(plan_cache) / f"{area_key(build_area)}-{seed}-{mode}.resume"
+        key = resume_path.read_text() if resume_path.exists() else None
+        if key is None or not (Path(plan_cache) / f"{key}.npz").exists():
+            key = plan_key(build_area, terrain_fingerprint(heightmap_layers(layers)), seed, mode)
+        plan_path, progress_path = Path(plan_cache) / f"{key}.npz", Path(plan_cache) / f"{key}.progress"
+
+    if plan_path is not None and plan_path.exists():
+        print(f"Replaying the generation plan {plan_path}")
+        plan = GenerationPlan.load(plan_path)
+        if resume_path is not None:
+            resume_path.write_text(key)
+        plan.emit(backend, progress_path)
+    else:
+        plan = GenerationPlan(seed)
+        if plan_path is not None:
+            plan_path.parent.mkdir(parents=True, exist_ok=True)
+            progress_path.unlink(missing_ok=True)
+            resume_path.write_text(key)
+        if send_queue > 0:
+            # The plan is saved once planned, the sender keeps the progress of the batches it sent, so that a run
+            # interrupted while sending resumes. One interrupted while planning plans again.
+            with PipelinedSender(lambda k: plan.emit_batch(backend, k, progress_path), send_queue) as sender:
+                plan_generation(backend, workers, plan, layers, road_waves, sender.submit, sender.lock)
+                if plan_path is not None:
+                    plan.save(plan_path)
+            print(sender.summary())
+            if progress_path is not None:
+                progress_path.unlink(missing_ok=True)
+        else:
+            plan_generation(backend, workers, plan, layers, road_waves)
+            if plan_path is not None:
+                plan.save(plan_path)
+            plan.emit(backend, progress_path)
+    if resume_path is not None:
+        resume_path.unlink(missing_ok=True)
+    if terrain_cache is not None and not isinstance(backend, OfflineEditor) and len(plan):
+        # The generation changed the terrain, the layers are computed again on the next run
+        terrain_cache.invalidate(backend)
+    if export is not None:
+        print(f"Exported {backend.export_structure(export)} blocks to {export}")
+    print("It may seems as nothing is happening but the editor is surely placing blocks")
+    print("Wait a bit or kill the process if it last too long")
+
+
+def plan_generation(backend, workers, plan: GenerationPlan, layers: dict, road_waves=None, on_batch=None,
+                    lock=None):
+    """Run the generation, recording what it places into the plan instead of sending it
+
+    on_batch is called with the index of every batch of the plan once recorded, the backend is only used under the
+    lock when given, as the batches are sent by another thread. The terrain of the placement map is
+    taken from layers, as made by terrain_cache.terrain_layers."""
+    # The world slice is loaded by the recorder once skipping the blocks already in the world or clearing above the
+    # roads reads it, the terrain itself comes from the layers
+    seed = plan.seed
+    editor = CoalescingEditor(PlanRecorder(backend, plan, on_batch, lock), skip_unchanged=True)
+
+    placement_map = PlacementMap(editor, terrain=(layers['no_trees'], layers['dry_mask']))
+
+    debug_palette = [Block(color + "_concrete") for color in ["lime", "yellow", "red", "purple", "black"]][::-1]
+    palette_size = len(debug_palette)
+
     def house_builder(center, radius):
         x, y, z = center
         geometry.placeBoxHollow(editor, Box((x - radius, y, z - radius), (radius * 2, radius * 2, radius * 2)), Block('oak_planks'))
 
-    territory.build_territories(placement_map, batiment_builder)
+    if workers is None:
+        random.seed(seed)
+        castles = [castle.to_plan() for castle in
+                   territory.build_territories(placement_map, castle_builder(editor, placement_map),
+                                               road_waves=road_waves)]
+    else:
+        castles = build_territories_parallel(placement_map, castle_builder, workers, seed, road_waves=road_waves)
 
     editor.flushBuffer()
-    print("It may seems as nothing is happening but the editor is surely placing blocks")
-    print("Wait a bit or kill the process if it last too long")
+    plan.castles, plan.roads = castles, placement_map.roads_plan()
+    stats = editor.report()
+    print(f"Coalescing removed {stats['writes_removed']} of {stats['writes_received']} block writes")
+    print(f"Planned {stats['blocks_planned']} blocks, skipped {stats['blocks_skipped']} already in the world, "
+          f"kept {stats['blocks_sent']}")
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save-snapshot', help="save the build area of the server to this file and exit")
+    parser.add_argument('--snapshot', help="generate offline from a saved snapshot instead of the server")
+    parser.add_argument('--export', help="with --snapshot, write the generated blocks to this structure file")
+    parser.add_argument('--report', default="run_report.json", help="write the timings and counters of the run here")
+    parser.add_argument('--profile', help="run under cProfile and write the stats to this file")
+    parser.add_argument('--workers', type=int, help="plan the districts in parallel with this many processes")
+    parser.add_argument('--seed', type=int, help="seed of the random generation, to reproduce a run")
+    parser.add_argument('--plan-cache', default=".plan_cache",
+                        help="directory of the generation plans, a run with the same build area, terrain and seed "
+                             "replays its plan instead of planning again")
+    parser.add_argument('--road-waves', type=int,
+                        help="route the roads around a castle in this many batched searches, faster but the roads "
+                             "share less of their path")
+    parser.add_argument('--send-queue', type=int, default=4,
+                        help="batches planned ahead of the server while sending, 0 to send once everything is planned")
+    parser.add_argument('--terrain-cache', default=".terrain_cache",
+                        help="directory of the terrain layers of the build areas, reused while the terrain is unchanged")
+    args = parser.parse_args()
+    if args.save_snapshot is not None:
+        save_snapshot(Editor(), args.save_snapshot)
+    else:
+        with profiled(args.profile):
+            main(args.snapshot, args.export, args.workers, args.seed, args.plan_cache, args.terrain_cache,
+                 args.send_queue, args.road_waves)
+        print(report.summary())
+        report.save(args.report)
     print("Generation about to end, thank you for using this castle generator.")
 
 
@@ -0,0 +1,224 @@
+import gzip
+import random
+import re
+import types
+from io import BytesIO
+
+import numpy as np
+from gdpc import Block, Box, interface
+from gdpc.vector_tools import Rect
+from gdpc import world_slice
+from gdpc.world_slice import WorldSlice
+from nbt import nbt
+
+from coord_batch import as_coord_batch, as_position_batch
+from world_diff import block_key, normalize_id
+
+FILL_COMMAND = re.compile(r"fill (-?\d+) (-?\d+) (-?\d+) (-?\d+) (-?\d+) (-?\d+) (\S+)$")
+
+
+def save_snapshot(editor, path):
+    """Save the build area of the editor and the raw chunks around it, for an OfflineEditor to load"""
+    build_area = editor.getBuildArea()
+    rect = build_area.toRect()
+    chunk_offset = rect.offset >> 4
+    chunk_size = (rect.last >> 4) - chunk_offset + 1
+    chunks = interface.getChunks(chunk_offset, chunk_size, asBytes=True, host=editor.host)
+    np.savez_compressed(path, begin=np.array(tuple(build_area.begin)), size=np.array(tuple(build_area.size)),
+                        chunks=np.frombuffer(chunks, dtype=np.uint8))
+
+
+class _SavedChunks:
+    """Stands for gdpc.interface in SnapshotWorldSlice, serving chunk bytes instead of fetching them"""
+
+    def __init__(self, chunks: bytes):
+        self.chunks = chunks
+
+    def getChunks(self, *args, **kwargs) -> bytes:
+        return self.chunks
+
+
+class SnapshotWorldSlice(WorldSlice):
+    """WorldSlice built from chunk bytes previously fetched from the server
+
+    WorldSlice only knows how to fetch its chunks from the server, its parsing is reused through a copy of its
+    __init__ that sees _SavedChunks as the interface module. Nothing global is replaced, a real Editor of the same
+    process keeps working."""
+
+    def __init__(self, rect: Rect, chunks: bytes):
+        parse = WorldSlice.__init__
+        parse = types.FunctionType(parse.__code__, {**vars(world_slice), 'interface': _SavedChunks(chunks)},
+                                   parse.__name__, parse.__defaults__, parse.__closure__)
+        parse(self, rect)
+
+
+def load_world_slice(rect: Rect, chunks: bytes) -> WorldSlice:
+    """Build a WorldSlice from chunk bytes previously fetched from the server"""
+    return SnapshotWorldSlice(rect, chunks)
+
+
+class OfflineEditor:
+    """Editor reading the world from a saved snapshot and recording the placed blocks instead of sending them
+
+    Placed blocks are kept in a palette-indexed volume, 0 meaning untouched, split in 16x16x16 sections allocated on
+    first write. Fill commands are applied to the volume unless apply_fill is False, other commands are only recorded.
+    The result can be exported as a structure file."""
+
+    def __init__(self, build_area: Box, chunks: bytes | None = None, apply_fill=True):
+        self.build_area = build_area
+        # Without chunks, the editor has no world to read from and only records blocks
+        self.chunks = chunks
+        self.apply_fill = apply_fill
+        self.palette: list[Block] = [Block('structure_void')]
+        self.palette_ids: dict = {}
+        self.sections: dict[tuple[int, int, int], np.ndarray] = {}
+        self.commands: list[str] = []
+        self.blocks_placed = 0
+        self.flushes = 0
+        self.worldSlice: WorldSlice | None = None
+        self.worldSliceDecay: np.ndarray | None = None
+
+    @classmethod
+    def from_snapshot(cls, snapshot_path):
+        snapshot = np.load(snapshot_path)
+        return cls(Box(tuple(snapshot['begin'].tolist()), tuple(snapshot['size'].tolist())),
+                   snapshot['chunks'].tobytes())
+
+    def getBuildArea(self) -> Box:
+        return self.build_area
+
+    def loadWorldSlice(self, rect=None, heightmapTypes=None, cache=False) -> WorldSlice:
+        if self.chunks is None:
+            raise ValueError("This offline editor has no snapshot to load a world slice from")
+        world_slice = load_world_slice(self.build_area.toRect() if rect is None else rect, self.chunks)
+        if cache:
+            self.worldSlice = world_slice
+            self.worldSliceDecay = np.zeros(tuple(world_slice.box.size), dtype=bool)
+        return world_slice
+
+    def palette_id(self, block: Block) -> int:
+        key = block_key(block) or (block.id, str(block.states), block.data)
+        if key not in self.palette_ids:
+            self.palette_ids[key] = len(self.palette)
+            self.palette.append(block)
+        return self.palette_ids[key]
+
+    def __record(self, batch, ids):
+        if not len(batch):
+            return
+        sections, inverse = np.unique(batch >> 4, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        # Rows of the same section are contiguous once sorted, later writes staying after earlier ones
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(sections) + 1))
+        local = batch & 15
+        for k, section in enumerate(map(tuple, sections.tolist())):
+            if section not in self.sections:
+                self.sections[section] = np.zeros((16, 16, 16), dtype=np.uint16)
+            rows = order[bounds[k]:bounds[k + 1]]
+            self.sections[section][local[rows, 0], local[rows, 1], local[rows, 2]] = ids[rows]
+        if self.worldSlice is not None:
+            box = self.worldSlice.box
+            in_slice = batch - np.array(tuple(box.offset), dtype=np.int32)
+            in_slice = in_slice[np.all((in_slice >= 0) & (in_slice < np.array(self.worldSliceDecay.shape)), axis=1)]
+            self.worldSliceDecay[in_slice[:, 0], in_slice[:, 1], in_slice[:, 2]] = True
+        self.blocks_placed += len(batch)
+
+    def recorded(self) -> tuple[np.ndarray, np.ndarray]:
+        """Return the positions of every recorded block, as an Nx3 coordinate batch, and their palette ids"""
+        positions, ids = [], []
+        for section, volume in self.sections.items():
+            local = np.argwhere(volume)
+            positions.append(local + np.array(section) * 16)
+            ids.append(volume[tuple(local.T)])
+        if not positions:
+            return as_coord_batch([]), np.zeros(0, dtype=np.uint16)
+        return as_coord_batch(np.concatenate(positions)), np.concatenate(ids)
+
+    def placeBlock(self, position, block, replace=None):
+        batch = as_position_batch(position)
+        if replace is not None:
+            replace_ids = {normalize_id(r) for r in ([replace] if isinstance(replace, str) else replace)}
+            keep = [normalize_id(self.getBlock(p).id) in replace_ids for p in batch.tolist()]
+            batch = batch[np.array(keep, dtype=bool).reshape(-1)]
+        if isinstance(block, Block):
+            ids = np.full(len(batch), self.palette_id(block), dtype=np.uint16)
+        else:
+            ids = np.array([self.palette_id(random.choice(block)) for _ in range(len(batch))], dtype=np.uint16)
+        self.__record(batch, ids)
+        return True
+
+    def getBlock(self, position) -> Block:
+        x, y, z = (int(c) for c in position)
+        section = self.sections.get((x >> 4, y >> 4, z >> 4))
+        block_id = 0 if section is None else int(section[x & 15, y & 15, z & 15])
+        if block_id:
+            return self.palette[block_id]
+        if self.worldSlice is None:
+            self.loadWorldSlice(cache=True)
+        return self.worldSlice.getBlockGlobal((x, y, z))
+
+    def runCommand(self, command: str, position=None, syncWithBuffer=False):
+        self.commands.append(command)
+        match = FILL_COMMAND.match(command)
+        if match is None or position is not None or not self.apply_fill:
+            return
+        low = np.minimum([int(c) for c in match.groups()[:3]], [int(c) for c in match.groups()[3:6]])
+        high = np.maximum([int(c) for c in match.groups()[:3]], [int(c) for c in match.groups()[3:6]])
+        xs, ys, zs = np.meshgrid(*(np.arange(lo, hi + 1) for lo, hi in zip(low, high)), indexing='ij')
+        batch = as_coord_batch(np.column_stack((xs.ravel(), ys.ravel(), zs.ravel())))
+        self.__record(batch, np.full(len(batch), self.palette_id(Block(match.group(7))), dtype=np.uint16))
+
+    def flushBuffer(self):
+        self.flushes += 1
+
+    def export_structure(self, path):
+        """Write the recorded blocks of the build area as a gzipped structure file, untouched blocks left out"""
+        positions, ids = self.recorded()
+        inside = np.all((positions >= np.array(tuple(self.build_area.begin))) &
+                        (positions < np.array(tuple(self.build_area.end))), axis=1)
+        local = positions[inside] - np.array(tuple(self.build_area.begin), dtype=np.int32)
+        used, state_ids = np.unique(ids[inside], return_inverse=True)
+
+        root = nbt.NBTFile()
+        root.tags.append(nbt.TAG_Int(name='DataVersion', value=self.__data_version()))
+        size = nbt.TAG_List(name='size', type=nbt.TAG_Int)
+        size.tags.extend(nbt.TAG_Int(value=s) for s in self.build_area.size)
+        root.tags.append(size)
+
+        palette = nbt.TAG_List(name='palette', type=nbt.TAG_Compound)
+        for block_id in used.tolist():
+            block = self.palette[block_id]
+            state = nbt.TAG_Compound()
+            state.tags.append(nbt.TAG_String(name='Name', value=normalize_id(block.id)))
+            if block.states:
+                properties = nbt.TAG_Compound(name='Properties')
+                properties.tags.extend(nbt.TAG_String(name=str(k), value=str(v)) for k, v in block.states.items())
+                state.tags.append(properties)
+            palette.tags.append(state)
+        root.tags.append(palette)
+
+        blocks = nbt.TAG_List(name='blocks', type=nbt.TAG_Compound)
+        for position, state_id in zip(local.tolist(), state_ids.reshape(-1).tolist()):
+            entry = nbt.TAG_Compound()
+            pos = nbt.TAG_List(name='pos', type=nbt.TAG_Int)
+            pos.tags.extend(nbt.TAG_Int(value=c) for c in position)
+            entry.tags.append(pos)
+            entry.tags.append(nbt.TAG_Int(name='state', value=state_id))
+            blocks.tags.append(entry)
+        root.tags.append(blocks)
+        root.tags.append(nbt.TAG_List(name='entities', type=nbt.TAG_Compound))
+
+        buffer = BytesIO()
+        root.write_file(buffer=buffer)
+        with gzip.open(path, 'wb') as file:
+            file.write(buffer.getvalue())
+        return len(local)
+
+    def __data_version(self) -> int:
+        if self.chunks is None:
+            return 0
+        if self.worldSlice is None:
+            self.loadWorldSlice(cache=True)
+        chunk = self.worldSlice.nbt['Chunks'][0]
+        return chunk['DataVersion'].value if 'DataVersion' in chunk else 0
@@ -0,0 +1,69 @@
+import queue
+import threading
+import time
+from typing import Callable
+
+from instrumentation import report
+
+
+class PipelinedSender:
+    """Background thread sending the batches handed to it while the generation plans the next ones
+
+    At most max_pending batches wait to be sent, submit blocks while the queue is full so that the planning never runs
+    far ahead of the server. Batches are sent holding lock, the planning must hold it too to use the editor they are
+    sent to. After an error the sender drops the next batches, letting the planning end so that its plan can be saved
+    and sent again later, and close raises the error."""
+
+    def __init__(self, send: Callable[[int], int], max_pending=4):
+        """send(batch) sends a batch and returns its amount of blocks"""
+        self.send = send
+        self.queue: queue.Queue = queue.Queue(max_pending)
+        self.error: BaseException | None = None
+        self.lock = threading.RLock()
+        self.thread = threading.Thread(target=self.__run, name="block sender", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __run(self):
+        while (batch := self.queue.get()) is not None:
+            if self.error is not None:
+                # Keep draining the queue, the planning would wait forever on a full one
+                continue
+            try:
+                start = time.perf_counter()
+                with self.lock:
+                    blocks = self.send(batch)
+                report.count('pipeline', batches_sent=1, blocks_sent=blocks,
+                             send_seconds=time.perf_counter() - start)
+            except BaseException as error:
+                print(f"\nSending batch {batch} failed, the next batches are not sent: {error!r}")
+                self.error = error
+
+    def submit(self, batch):
+        depth, full = self.queue.qsize(), self.queue.full()
+        start = time.perf_counter()
+        self.queue.put(batch)
+        report.count('pipeline', batches_submitted=1, queue_depth_sum=depth, queue_full=int(full),
+                     planning_wait_seconds=time.perf_counter() - start)
+
+    def close(self):
+        """Wait for every submitted batch to be sent, raise the error of the sender if any"""
+        with report.phase('pipeline_drain'):
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    @staticmethod
+    def summary() -> str:
+        counters = report.phases['pipeline']['counters']
+        batches = max(counters['batches_submitted'], 1)
+        throughput = counters['blocks_sent'] / max(counters['send_seconds'], 1e-9)
+        return (f"Sent {counters['blocks_sent']} blocks in {counters['batches_sent']} batches, {throughput:.0f} blocks/s, "
+                f"mean queue depth {counters['queue_depth_sum'] / batches:.1f}, "
+                f"planning waited {counters['planning_wait_seconds']:.2f}s for the sender")
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import numpy as np
+
+
+class Region:
+    """Set of (x, z) columns of the build area, stored as a boolean mask aligned to it"""
+
+    def __init__(self, build_area, mask: np.ndarray | None = None):
+        self.build_area = build_area
+        self.origin = build_area.begin[0], build_area.begin[2]
+        if mask is None:
+            mask = np.zeros((build_area.size[0], build_area.size[2]), dtype=bool)
+        self.mask = mask
+
+    @classmethod
+    def from_coords(cls, build_area, xs, zs) -> Region:
+        region = cls(build_area)
+        region.add_many(xs, zs)
+        return region
+
+    def __to_indexes(self, xs, zs):
+        i = np.asarray(xs, dtype=np.int64) - self.origin[0]
+        j = np.asarray(zs, dtype=np.int64) - self.origin[1]
+        inside = (0 <= i) & (i < self.mask.shape[0]) & (0 <= j) & (j < self.mask.shape[1])
+        return i, j, inside
+
+    def __contains__(self, coord) -> bool:
+        i, j = coord[0] - self.origin[0], coord[1] - self.origin[1]
+        return 0 <= i < self.mask.shape[0] and 0 <= j < self.mask.shape[1] and bool(self.mask[i, j])
+
+    def contains_many(self, xs, zs) -> np.ndarray:
+        i, j, inside = self.__to_indexes(xs, zs)
+        result = np.zeros(inside.shape, dtype=bool)
+        result[inside] = self.mask[i[inside], j[inside]]
+        return result
+
+    def add_many(self, xs, zs):
+        i, j, inside = self.__to_indexes(xs, zs)
+        self.mask[i[inside], j[inside]] = True
+
+    def __iter__(self):
+        xs, zs = self.coords()
+        return zip(xs.tolist(), zs.tolist())
+
+    def __len__(self) -> int:
+        return self.area
+
+    def __bool__(self) -> bool:
+        return bool(self.mask.any())
+
+    @property
+    def area(self) -> int:
+        return int(np.count_nonzero(self.mask))
+
+    def coords(self) -> tuple[np.ndarray, np.ndarray]:
+        i, j = np.nonzero(self.mask)
+        return i + self.origin[0], j + self.origin[1]
+
+    def bounding_box(self) -> tuple[tuple[int, int], tuple[int, int]] | None:
+        """Return the lowest and highest (x, z) of the region, both included, or None if it is empty"""
+        rows = np.flatnonzero(self.mask.any(axis=1))
+        if not len(rows):
+            return None
+        cols = np.flatnonzero(self.mask.any(axis=0))
+        return (int(rows[0]) + self.origin[0], int(cols[0]) + self.origin[1]), \
+            (int(rows[-1]) + self.origin[0], int(cols[-1]) + self.origin[1])
+
+    def copy(self) -> Region:
+        return Region(self.build_area, self.mask.copy())
+
+    def __or__(self, other: Region) -> Region:
+        return Region(self.build_area, self.mask | other.mask)
+
+    def __and__(self, other: Region) -> Region:
+        return Region(self.build_area, self.mask & other.mask)
+
+    def __sub__(self, other: Region) -> Region:
+        return Region(self.build_area, self.mask & ~other.mask)
+
+    def __ior__(self, other: Region) -> Region:
+        self.mask |= other.mask
+        return self
+
+    def __iand__(self, other: Region) -> Region:
+        self.mask &= other.mask
+        return self
+
+    def __isub__(self, other: Region) -> Region:
+        self.mask &= ~other.mask
+        return self
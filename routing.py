@@ -0,0 +1,164 @@
+from heapq import heappush, heappop
+
+import networkx as nx
+import numpy as np
+
+
+class NoPathException(Exception):
+    pass
+
+
+# (di, dj, cost factor), diagonals cost twice as much
+GRID_NEIGHBORS = ((1, 0, 1), (-1, 0, 1), (0, 1, 1), (0, -1, 1),
+                  (1, 1, 2), (-1, 1, 2), (-1, -1, 2), (1, -1, 2))
+
+
+def edge_weight(height_a, height_b, factor):
+    return (100 + (abs(height_a - height_b) * 10) ** 2) * factor
+
+
+class NetworkxRouter:
+    """Routing backend on an explicit networkx graph, one node per column"""
+
+    def __init__(self, graph: nx.Graph):
+        self.graph = graph
+        self.last_expanded = None
+
+    def shortest_path(self, sources, target) -> list[tuple[int, int]]:
+        try:
+            return nx.multi_source_dijkstra(self.graph, sources, target)[1]
+        except nx.NetworkXException as e:
+            raise NoPathException(str(e))
+
+    def shortest_paths(self, sources, targets) -> dict[tuple[int, int], list[tuple[int, int]]]:
+        try:
+            paths = nx.multi_source_dijkstra_path(self.graph, set(sources))
+        except nx.NetworkXException as e:
+            raise NoPathException(str(e))
+        return {target: paths[target] for target in targets if target in paths}
+
+    def discount_edge(self, c1, c2, factor):
+        if self.graph.has_edge(c1, c2):
+            self.graph[c1][c2]['weight'] *= factor
+
+
+class GridRouter:
+    """Routing backend working directly on the heightmap
+
+    Edge weights are computed from the height deltas when an edge is relaxed, only the discounted edges are stored.
+    Paths are found with A*, using the manhattan distance times the cheapest possible step as heuristic."""
+
+    def __init__(self, height_map: np.ndarray, origin: tuple[int, int]):
+        self.shape = height_map.shape
+        self.origin = origin
+        self.heights = np.asarray(height_map, dtype=np.int64).ravel().tolist()
+        # Discount factor of the edges used by roads, keyed by (lowest index, highest index)
+        self.discounts: dict[tuple[int, int], float] = {}
+        self.on_road = bytearray(self.shape[0] * self.shape[1])
+        self.min_discount = 1.
+        self.last_expanded = 0
+
+    def to_index(self, coord) -> int | None:
+        i, j = coord[0] - self.origin[0], coord[1] - self.origin[1]
+        if not (0 <= i < self.shape[0] and 0 <= j < self.shape[1]):
+            return None
+        return i * self.shape[1] + j
+
+    def to_coord(self, index) -> tuple[int, int]:
+        i, j = divmod(index, self.shape[1])
+        return i + self.origin[0], j + self.origin[1]
+
+    def shortest_path(self, sources, target) -> list[tuple[int, int]]:
+        paths = self.shortest_paths(sources, [target])
+        if target not in paths:
+            raise NoPathException("No path between sources and target")
+        return paths[target]
+
+    def shortest_paths(self, sources, targets) -> dict[tuple[int, int], list[tuple[int, int]]]:
+        """Return the shortest path from the nearest source to every reachable target, from a single search
+
+        The heuristic is the distance bound to the nearest target, so the search stops as soon as every target
+        is settled."""
+        source_indexes = [self.to_index(source) for source in sources]
+        target_indexes = {self.to_index(target): target for target in targets}
+        if not source_indexes or None in source_indexes:
+            raise NoPathException("Source outside of the grid")
+        target_indexes.pop(None, None)
+        if not target_indexes:
+            return {}
+
+        size_i, size_j = self.shape
+        heights, on_road, discounts = self.heights, self.on_road, self.discounts
+        target_coords = [divmod(index, size_j) for index in target_indexes]
+        # Cheapest step possible: an ortho step on flat ground along the most discounted road
+        step_bound = 100 * self.min_discount
+
+        def heuristic(i, j):
+            return min(abs(i - target_i) + abs(j - target_j) for target_i, target_j in target_coords) * step_bound
+
+        distances = {}
+        previous = {}
+        closed = bytearray(size_i * size_j)
+        heap = []
+        for index in source_indexes:
+            distances[index] = 0
+            previous[index] = None
+            heappush(heap, (heuristic(*divmod(index, size_j)), 0, index))
+
+        remaining = len(target_indexes)
+        expanded = 0
+        while heap and remaining:
+            _, cost, current = heappop(heap)
+            if closed[current]:
+                continue
+            closed[current] = 1
+            expanded += 1
+            if current in target_indexes:
+                remaining -= 1
+
+            current_i, current_j = divmod(current, size_j)
+            current_height = heights[current]
+            for di, dj, factor in GRID_NEIGHBORS:
+                i, j = current_i + di, current_j + dj
+                if not (0 <= i < size_i and 0 <= j < size_j):
+                    continue
+                neighbor = i * size_j + j
+                if closed[neighbor]:
+                    continue
+                weight = (100 + (abs(current_height - heights[neighbor]) * 10) ** 2) * factor
+                if on_road[current] and on_road[neighbor]:
+                    weight *= discounts.get((min(current, neighbor), max(current, neighbor)), 1)
+                new_cost = cost + weight
+                if new_cost < distances.get(neighbor, float('inf')):
+                    distances[neighbor] = new_cost
+                    previous[neighbor] = current
+                    heappush(heap, (new_cost + heuristic(i, j), new_cost, neighbor))
+
+        self.last_expanded = expanded
+        paths = {}
+        for index, target in target_indexes.items():
+            if not closed[index]:
+                continue
+            path = []
+            current = index
+            while current is not None:
+                path.append(self.to_coord(current))
+                current = previous[current]
+            paths[target] = path[::-1]
+        return paths
+
+    def has_edge(self, c1, c2) -> bool:
+        a, b = self.to_index(c1), self.to_index(c2)
+        if a is None or b is None:
+            return False
+        return max(abs(c1[0] - c2[0]), abs(c1[1] - c2[1])) == 1
+
+    def discount_edge(self, c1, c2, factor):
+        if not self.has_edge(c1, c2):
+            return
+        a, b = self.to_index(c1), self.to_index(c2)
+        key = (min(a, b), max(a, b))
+        self.discounts[key] = self.discounts.get(key, 1) * factor
+        self.min_discount = min(self.min_discount, self.discounts[key])
+        self.on_road[a] = 1
+        self.on_road[b] = 1
@@ -0,0 +1,67 @@
+import numpy as np
+
+from window_stats import window_tile, affected_samples
+
+
+class ScoreLayerCache:
+    """Keep the score layers of a PlacementMap between calls to get_score_map
+
+    Layers are keyed by (layer, sampling, blur, factor). Static layers are computed once, windowed layers over a
+    mutable map (occupation, bonus) track which of their tiles are outdated and only recompute those."""
+
+    def __init__(self):
+        self.layers: dict[tuple, np.ndarray] = {}
+        self.dirty_tiles: dict[tuple, np.ndarray] = {}
+        self.windowed: dict[tuple, tuple] = {}
+        self.full_computations = 0
+        self.tile_computations = 0
+
+    def get_layer(self, key, compute):
+        if key not in self.layers:
+            self.layers[key] = compute()
+            self.full_computations += 1
+        return self.layers[key]
+
+    def get_windowed_layer(self, key, source, _map, sampling, blur, window_fct, factor=1):
+        """Return window_fct over every sampled window of _map, times factor
+
+        The layer is marked outdated by mark_dirty(source, ...) whenever _map is written."""
+        if key not in self.layers:
+            self.layers[key] = window_fct(_map, sampling, blur) * factor
+            self.dirty_tiles[key] = np.zeros(self.layers[key].shape, dtype=bool)
+            self.windowed[key] = (source, sampling, blur)
+            self.full_computations += 1
+            return self.layers[key]
+
+        layer, dirty = self.layers[key], self.dirty_tiles[key]
+        dirty_rows = np.flatnonzero(dirty.any(axis=1))
+        if len(dirty_rows):
+            # Recompute each band of consecutive dirty rows on the columns it needs
+            bands = np.split(dirty_rows, np.flatnonzero(np.diff(dirty_rows) > 1) + 1)
+            for band in bands:
+                rows = band[0], band[-1] + 1
+                dirty_cols = np.flatnonzero(dirty[rows[0]:rows[1]].any(axis=0))
+                cols = dirty_cols[0], dirty_cols[-1] + 1
+                layer[rows[0]:rows[1], cols[0]:cols[1]] = \
+                    window_tile(window_fct, _map, sampling, blur, rows, cols) * factor
+                self.tile_computations += 1
+            dirty[:] = False
+        return layer
+
+    def mark_dirty(self, source, low_i, high_i, low_j, high_j):
+        """Flag the tiles of every layer computed over source whose window overlaps the cells
+        [low_i, high_i) x [low_j, high_j)"""
+        if low_i >= high_i or low_j >= high_j:
+            return
+        for key, (layer_source, sampling, blur) in self.windowed.items():
+            if layer_source != source:
+                continue
+            dirty = self.dirty_tiles[key]
+            first_i, end_i = affected_samples(low_i, high_i, sampling, blur, dirty.shape[0])
+            first_j, end_j = affected_samples(low_j, high_j, sampling, blur, dirty.shape[1])
+            dirty[first_i:end_i, first_j:end_j] = True
+
+    def clear(self):
+        self.layers.clear()
+        self.dirty_tiles.clear()
+        self.windowed.clear()
@@ -0,0 +1,83 @@
+import math
+from collections import defaultdict
+from typing import Any
+
+from utils import get_distance
+
+
+class SpatialIndex:
+    """Uniform grid hash of structures placed on the (x, z) plane
+
+    Nearest and within-radius queries only look at the grid cells that can contain an answer. Items at the same
+    distance are returned in insertion order."""
+
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], list[tuple[int, tuple, Any]]] = defaultdict(list)
+        self.size = 0
+        self.cell_bounds = None
+
+    def __len__(self):
+        return self.size
+
+    def __cell(self, coord):
+        return math.floor(coord[0] / self.cell_size), math.floor(coord[1] / self.cell_size)
+
+    def insert(self, coord, item):
+        cell = self.__cell(coord)
+        self.cells[cell].append((self.size, (coord[0], coord[1]), item))
+        self.size += 1
+        if self.cell_bounds is None:
+            self.cell_bounds = [cell[0], cell[1], cell[0], cell[1]]
+        else:
+            self.cell_bounds = [min(self.cell_bounds[0], cell[0]), min(self.cell_bounds[1], cell[1]),
+                                max(self.cell_bounds[2], cell[0]), max(self.cell_bounds[3], cell[1])]
+
+    def __ring_cells(self, center_cell, ring):
+        ci, cj = center_cell
+        if ring == 0:
+            yield center_cell
+            return
+        for i in range(ci - ring, ci + ring + 1):
+            yield i, cj - ring
+            yield i, cj + ring
+        for j in range(cj - ring + 1, cj + ring):
+            yield ci - ring, j
+            yield ci + ring, j
+
+    def __max_ring(self, center_cell):
+        min_i, min_j, max_i, max_j = self.cell_bounds
+        return max(abs(center_cell[0] - min_i), abs(center_cell[0] - max_i),
+                   abs(center_cell[1] - min_j), abs(center_cell[1] - max_j))
+
+    def nearest(self, coord) -> tuple[float, Any] | None:
+        """Return (distance, item) for the nearest item, or None if the index is empty"""
+        if not self.size:
+            return None
+        center_cell = self.__cell(coord)
+        best = None
+        for ring in range(self.__max_ring(center_cell) + 1):
+            # Every item from this ring on is at least this far away
+            if best is not None and best[0] < (ring - 1) * self.cell_size:
+                break
+            for cell in self.__ring_cells(center_cell, ring):
+                for seq, item_coord, item in self.cells.get(cell, ()):
+                    distance = get_distance(item_coord, (coord[0], coord[1]))
+                    if best is None or (distance, seq) < best[:2]:
+                        best = (distance, seq, item)
+        return best[0], best[2]
+
+    def within(self, coord, radius) -> list[tuple[float, Any]]:
+        """Return the (distance, item) of every item at most radius away, nearest first"""
+        if not self.size:
+            return []
+        low = self.__cell((coord[0] - radius, coord[1] - radius))
+        high = self.__cell((coord[0] + radius, coord[1] + radius))
+        found = []
+        for i in range(max(low[0], self.cell_bounds[0]), min(high[0], self.cell_bounds[2]) + 1):
+            for j in range(max(low[1], self.cell_bounds[1]), min(high[1], self.cell_bounds[3]) + 1):
+                for seq, item_coord, item in self.cells.get((i, j), ()):
+                    distance = get_distance(item_coord, (coord[0], coord[1]))
+                    if distance <= radius:
+                        found.append((distance, seq, item))
+        return [(distance, item) for distance, _, item in sorted(found, key=lambda f: f[:2])]
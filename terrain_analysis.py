@@ -0,0 +1,121 @@
+from math import ceil, log2
+
+import numpy as np
+
+NOT_GROUND_PATTERNS = ('air', 'leaves', 'log', 'vine', 'bamboo')
+
+
+def is_not_ground(block_id: str) -> bool:
+    for p in NOT_GROUND_PATTERNS:
+        if p in block_id:
+            return True
+    return False
+
+
+def is_air(block_id: str) -> bool:
+    return 'air' in block_id
+
+
+def classify_palette(palette, classifier=is_not_ground) -> np.ndarray:
+    """Evaluate the classifier once per block state of a section palette"""
+    return np.array([classifier(entry['Name'].value) for entry in palette], dtype=bool)
+
+
+def decode_block_states(data, palette_size) -> np.ndarray:
+    """Unpack a section's bit-packed palette indices into a (y, z, x) array of shape (16, 16, 16)"""
+    if data is None or len(data) == 0:
+        return np.zeros((16, 16, 16), dtype=np.int64)
+    bits = max(4, ceil(log2(palette_size)))
+    entries_per_long = 64 // bits
+    longs = np.array(data.value if hasattr(data, 'value') else data, dtype=np.int64).view(np.uint64)
+    shifts = (np.arange(entries_per_long, dtype=np.uint64) * np.uint64(bits))
+    indices = (longs[:, np.newaxis] >> shifts) & np.uint64((1 << bits) - 1)
+    return indices.reshape(-1)[:16 * 16 * 16].astype(np.int64).reshape((16, 16, 16))
+
+
+def iter_sections(world_slice):
+    """Yield (chunk_x, section_y, chunk_z, palette, data) for every non-empty section of the world slice,
+    chunk coordinates being local to the world slice chunk rect"""
+    chunk_rect_size = world_slice.chunkRect.size
+    for chunk_x in range(chunk_rect_size[0]):
+        for chunk_z in range(chunk_rect_size[1]):
+            chunk_tag = world_slice.nbt['Chunks'][chunk_x + chunk_z * chunk_rect_size[0]]
+            for section_tag in chunk_tag['sections']:
+                if 'block_states' not in section_tag or len(section_tag['block_states']) == 0:
+                    continue
+                block_states = section_tag['block_states']
+                data = block_states['data'] if 'data' in block_states else None
+                yield chunk_x, int(section_tag['Y'].value), chunk_z, block_states['palette'], data
+
+
+def section_layers(world_slice, classifier=is_not_ground, section_range=None):
+    """Return a dict mapping each section Y to a boolean (x, 16, z) slab covering the world slice rect,
+    True where the classifier holds. Missing sections are reported as void air.
+
+    If section_range is given, only the sections whose Y is in it are decoded."""
+    rect = world_slice.rect
+    offset_x, offset_z = rect.offset[0] % 16, rect.offset[1] % 16
+    chunk_size = world_slice.chunkRect.size
+    void_value = classifier('minecraft:void_air')
+
+    layers = {}
+    for chunk_x, section_y, chunk_z, palette, data in iter_sections(world_slice):
+        if section_range is not None and section_y not in section_range:
+            continue
+        if section_y not in layers:
+            layers[section_y] = np.full((chunk_size[0] * 16, 16, chunk_size[1] * 16), void_value, dtype=bool)
+        classes = classify_palette(palette, classifier)[decode_block_states(data, len(palette))]
+        # (y, z, x) -> (x, y, z)
+        layers[section_y][chunk_x * 16:(chunk_x + 1) * 16, :, chunk_z * 16:(chunk_z + 1) * 16] = \
+            classes.transpose((2, 0, 1))
+
+    return {y: layer[offset_x:offset_x + rect.size[0], :, offset_z:offset_z + rect.size[1]]
+            for y, layer in layers.items()}
+
+
+def heightmap_no_trees(world_slice, heightmap) -> np.ndarray:
+    """Return the heightmap lowered through every tree-like block (air, leaves, logs, vines, bamboo)
+
+    Gives the same result as probing every column downward block per block from `heightmap - 1`,
+    but each block state is classified once per palette and columns are scanned section by section."""
+    heightmap = np.array(heightmap, dtype=int)
+    result = heightmap.copy()
+    unresolved = np.ones(heightmap.shape, dtype=bool)
+    void_value = is_not_ground('minecraft:void_air')
+
+    layers = section_layers(world_slice)
+    top_section = (int(heightmap.max()) - 1) // 16
+    bottom_section = world_slice.yBegin // 16
+    local_y = np.arange(16)[np.newaxis, :, np.newaxis]
+    for section_y in range(top_section, bottom_section - 1, -1):
+        if not unresolved.any():
+            break
+        layer = layers.get(section_y)
+        if layer is None:
+            if void_value:
+                continue
+            layer = np.zeros((heightmap.shape[0], 16, heightmap.shape[1]), dtype=bool)
+
+        ys = section_y * 16 + local_y
+        # Only blocks under the initial height are probed
+        ground = ~layer & (ys < heightmap[:, np.newaxis, :])
+        has_ground = ground.any(axis=1) & unresolved
+        highest_ground = 15 - np.argmax(ground[:, ::-1, :], axis=1)
+        result[has_ground] = section_y * 16 + highest_ground[has_ground] + 1
+        unresolved &= ~has_ground
+
+    # Columns with no ground at all are set to the bottom of the world
+    result[unresolved] = world_slice.yBegin
+    return result
+
+
+def air_volume(world_slice, y_begin, y_end) -> np.ndarray:
+    """Return a boolean (x, y, z) volume over the world slice rect for y in [y_begin, y_end), True where the block
+    is any kind of air"""
+    rect = world_slice.rect
+    volume = np.ones((rect.size[0], y_end - y_begin, rect.size[1]), dtype=bool)
+    layers = section_layers(world_slice, is_air, range(y_begin // 16, (y_end - 1) // 16 + 1))
+    for section_y, layer in layers.items():
+        low, high = max(section_y * 16, y_begin), min(section_y * 16 + 16, y_end)
+        volume[:, low - y_begin:high - y_begin, :] = layer[:, low - section_y * 16:high - section_y * 16, :]
+    return volume
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import requests
+
+from offline_editor import OfflineEditor
+from terrain_analysis import heightmap_no_trees
+
+# Heightmaps of the world slice used by the generation
+HEIGHTMAPS = ["MOTION_BLOCKING", "MOTION_BLOCKING_NO_LEAVES", "OCEAN_FLOOR"]
+
+
+def area_key(build_area) -> str:
+    return hashlib.sha1(f"{tuple(build_area.begin)} {tuple(build_area.size)}".encode()).hexdigest()[:20]
+
+
+def heightmap_layers(heightmaps: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """The heightmaps used by the generation, out of every heightmap or cached layer"""
+    return {name: heightmaps[name] for name in HEIGHTMAPS}
+
+
+def terrain_layers(world_slice) -> dict[str, np.ndarray]:
+    """Every layer of the cache: the heightmaps, the heightmap without trees and the dry mask of the placement map"""
+    layers = heightmap_layers(world_slice.heightmaps)
+    layers['no_trees'] = heightmap_no_trees(world_slice, layers['MOTION_BLOCKING_NO_LEAVES'])
+    layers['dry_mask'] = layers['MOTION_BLOCKING'] == layers['OCEAN_FLOOR']
+    return layers
+
+
+def server_heightmap(editor) -> np.ndarray | None:
+    """MOTION_BLOCKING heightmap of the build area from the /heightmap endpoint of GDMC-HTTP, None without it"""
+    try:
+        response = requests.get(f"{editor.host}/heightmap", params={'type': 'MOTION_BLOCKING'},
+                                timeout=editor.timeout)
+        response.raise_for_status()
+        return np.array(response.json(), dtype=np.int64)
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def change_fingerprint(editor) -> str:
+    """Hash of the whole terrain of the build area, different as soon as the cached layers are outdated
+
+    A snapshot is hashed whole. For a server, the MOTION_BLOCKING heightmap of the build area is hashed, asked to the
+    server alone when it can, read from the world slice otherwise."""
+    digest = hashlib.sha1()
+    if isinstance(editor, OfflineEditor):
+        digest.update(editor.chunks or b'')
+        return 'snapshot:' + digest.hexdigest()
+    heightmap = server_heightmap(editor)
+    source = 'server'
+    if heightmap is None:
+        if editor.worldSlice is None:
+            editor.loadWorldSlice(cache=True)
+        heightmap, source = editor.worldSlice.heightmaps['MOTION_BLOCKING'], 'slice'
+    digest.update(np.ascontiguousarray(heightmap, dtype=np.int64).tobytes())
+    return f'{source}:{digest.hexdigest()}'
+
+
+class TerrainCache:
+    """Terrain layers of build areas kept on disk between runs, one directory of .npy files per build area
+
+    The layers are memory mapped when loaded, a run only reads the pages it uses. They must be saved before the
+    generation changes the world, and invalidated once it did."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def path(self, editor) -> Path:
+        return self.directory / area_key(editor.getBuildArea())
+
+    def load(self, editor) -> dict[str, np.ndarray] | None:
+        """Return the cached layers of the build area of the editor, None if missing or outdated"""
+        path = self.path(editor)
+        if not (path / 'meta.json').exists():
+            return None
+        meta = json.loads((path / 'meta.json').read_text())
+        if meta['fingerprint'] != change_fingerprint(editor):
+            print("The terrain of the build area changed since it was cached")
+            return None
+        return {name: np.load(path / f"{name}.npy", mmap_mode='r') for name in meta['layers']}
+
+    def save(self, editor, layers: dict[str, np.ndarray]):
+        """Store the layers of the build area of the editor, as the world is now"""
+        path = self.path(editor)
+        # Written aside then renamed, a cache is never read half written
+        temporary = path.with_name(path.name + '.tmp')
+        shutil.rmtree(temporary, ignore_errors=True)
+        temporary.mkdir(parents=True)
+        for name, layer in layers.items():
+            np.save(temporary / f"{name}.npy", np.ascontiguousarray(layer))
+        (temporary / 'meta.json').write_text(json.dumps({'layers': list(layers),
+                                                         'fingerprint': change_fingerprint(editor)}))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temporary, path)
+
+    def invalidate(self, editor):
+        shutil.rmtree(self.path(editor), ignore_errors=True)
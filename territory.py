@@ -1,11 +1,25 @@
+import time
+
 from gdpc import Block
 
 from PlacementMap import PlacementMap, NoValidPositionException
-from blob_expand import blob_expand, CoordExplore
+from blob_expand import blob_expand_mask, CoordExplore
+from region import Region
 from utils import coord3d_list_to_2d
 
 
-def build_territories(placement_map: PlacementMap, batiment_builder):
+# (radius, minimum score) of every district to place
+DISTRICT_SIZES = [(70, 0.01)]
+ROAD_PATTERN = {"INNER": {"stone": 1.0},
+                "MIDDLE": {"stone": 1.0},
+                "OUTER": {"stone": 1.0}}
+
+
+def build_territories(placement_map: PlacementMap, batiment_builder, district_sizes=DISTRICT_SIZES,
+                      road_waves=None) -> list:
+    """Build a castle on every district and the roads around it, return the castles
+
+    With road_waves, the roads around a castle are routed in that many batched searches, see generate_roads_around"""
 
     def coord2d_to_3d_surface(coord: CoordExplore, shift: tuple[int, int, int] = None):
         if shift is None:
@@ -16,10 +30,26 @@ def build_territories(placement_map: PlacementMap, batiment_builder):
     debug_palette = [Block(color + "_concrete") for color in ["lime", "yellow", "red", "purple", "black"]]
     palette_size = len(debug_palette)
 
+    district_centers, district_radius = reserve_districts(placement_map, district_sizes)
+    connect_districts(placement_map, district_centers)
+
+    castles = []
+    for center, radius in zip(district_centers, district_radius):
+        castle = batiment_builder(center, radius)
+        castles.append(castle)
+
+        generate_roads_around(placement_map, castle, center, radius * 1.5, 15, road_waves)
+    return castles
+
+
+def reserve_districts(placement_map: PlacementMap, district_sizes=DISTRICT_SIZES):
+    """Find a spot for every district, shrinking it until one is found, and occupy its territory
+
+    Return the centers and radii of the districts, or nothing at all if one of them has no spot"""
     district_centers = []
     district_radius = []
-    occupied_coords = set()
-    for district_size, tolerance in [(70, 0.01)]:
+    occupied = Region(placement_map.build_area)
+    for district_size, tolerance in district_sizes:
         try_amount = 50
         found_position = False
         print("Computing castle size", end="")
@@ -35,37 +65,43 @@ def build_territories(placement_map: PlacementMap, batiment_builder):
                 continue
         if not found_position:
             print("\nNo valid size found, exiting")
-            return
+            return [], []
         print(f"\nFound spot of radius {district_size} at ({x}, {z})")
-        district_coords = blob_expand(placement_map.build_area, placement_map.height_map, (x, z), max_distance=district_size, max_rel_diff=1, max_abs_diff=15, excluded_coords_set=occupied_coords)
-        for c in district_coords:
-            occupied_coords.add(c)
-        for coord in district_coords:
-            placement_map.occupy_coordinate(coord.x, coord.z)
-            # placement_map.editor.placeBlock(coord2d_to_3d_surface(coord, [0, -1, 0]), block)
+        district = Region(placement_map.build_area, blob_expand_mask(placement_map.build_area, placement_map.height_map, (x, z), max_distance=district_size, max_rel_diff=1, max_abs_diff=15, excluded_mask=occupied.mask))
+        occupied |= district
+        placement_map.occupy_region(district)
+    return district_centers, district_radius
+
 
+def connect_districts(placement_map: PlacementMap, district_centers):
     for a, b in zip(district_centers[1:], district_centers[:-1]):
         print("Computing roads between district")
         placement_map.compute_roads(a, b)
 
-    for center, radius in zip(district_centers, district_radius):
-        castle = batiment_builder(center, radius)
-
-        generate_roads_around(placement_map, castle, center, radius * 1.5, 15)
 
+def generate_roads_around(placement_map, castle, center, radius, road_amount, waves=None):
+    """Build roads from the outer gates of the castle to random points of the map
 
-def generate_roads_around(placement_map, castle, center, radius, road_amount):
+    waves=None routes the roads one by one, each one preferring the previous ones. With a number of waves, all the
+    roads of a wave are routed from a single search, which is much faster on big build areas."""
     print("Generating roads around the build area")
     print("This step can last a while as it scale badly with build area size")
     print("Terminate the program if it last too long")
     if not castle.rings[-1].gates:
         return
-    for point in placement_map.random_point_on_map(road_amount, center, radius, road_amount):
-        print("_", end="")
-        placement_map.compute_roads(coord3d_list_to_2d(castle.rings[-1].gates), point)
-        road_pattern = {"INNER": {"stone": 1.0},
-                        "MIDDLE": {"stone": 1.0},
-                        "OUTER": {"stone": 1.0}}
+    road_pattern = ROAD_PATTERN
+    gates = coord3d_list_to_2d(castle.rings[-1].gates)
+    points = list(placement_map.random_point_on_map(road_amount, center, radius, road_amount))
+    start_time = time.perf_counter()
+    if waves is None:
+        for point in points:
+            print("_", end="")
+            placement_map.compute_roads(gates, point)
+            placement_map.build_roads(road_pattern)
+            placement_map.editor.flushBuffer()
+    else:
+        placement_map.compute_roads_to_many(gates, points, waves=waves)
         placement_map.build_roads(road_pattern)
         placement_map.editor.flushBuffer()
+    print(f"\n{len(points)} roads routed in {time.perf_counter() - start_time:.2f}s")
     print("Road generation over")
@@ -0,0 +1,130 @@
+import io
+import threading
+
+import numpy as np
+import pytest
+from gdpc import Block, Box, Editor, interface
+from gdpc.vector_tools import Rect
+from nbt import nbt
+
+from block_buffer import CoalescingEditor
+from generation_plan import GenerationPlan, PlanRecorder
+
+Y_BEGIN, GROUND = -64, 64
+
+
+def flat_chunk_bytes() -> bytes:
+    """A single chunk of stone up to GROUND and air above it, as the server sends chunks"""
+    chunk = nbt.TAG_Compound()
+    chunk.tags.append(nbt.TAG_Int(name="yPos", value=Y_BEGIN // 16))
+    heightmaps = nbt.TAG_Compound(name="Heightmaps")
+    height, per_long = GROUND - Y_BEGIN, 64 // 9
+    packed = [sum(height << (9 * k) for k in range(min(per_long, 256 - start))) for start in range(0, 256, per_long)]
+    for name in ["MOTION_BLOCKING", "MOTION_BLOCKING_NO_LEAVES", "OCEAN_FLOOR", "WORLD_SURFACE"]:
+        heightmaps.tags.append(nbt.TAG_Long_Array(name=name))
+        heightmaps[name].value = packed
+    chunk.tags.append(heightmaps)
+    sections = nbt.TAG_List(name="sections", type=nbt.TAG_Compound)
+    for y in range(Y_BEGIN // 16, 20):
+        section = nbt.TAG_Compound()
+        section.tags.append(nbt.TAG_Byte(name="Y", value=y))
+        states, palette = nbt.TAG_Compound(name="block_states"), nbt.TAG_List(name="palette", type=nbt.TAG_Compound)
+        entry = nbt.TAG_Compound()
+        entry.tags.append(nbt.TAG_String(name="Name", value="minecraft:stone" if y * 16 < GROUND else "minecraft:air"))
+        palette.tags.append(entry)
+        states.tags.append(palette)
+        section.tags.append(states)
+        biomes, biome_palette = nbt.TAG_Compound(name="biomes"), nbt.TAG_List(name="palette", type=nbt.TAG_String)
+        biome_palette.tags.append(nbt.TAG_String("minecraft:plains"))
+        biomes.tags.append(biome_palette)
+        section.tags.append(biomes)
+        sections.tags.append(section)
+    chunk.tags.append(sections)
+    chunks = nbt.TAG_List(name="Chunks", type=nbt.TAG_Compound)
+    chunks.tags.append(chunk)
+    root = nbt.NBTFile()
+    root.tags.append(chunks)
+    buffer = io.BytesIO()
+    root.write_file(buffer=buffer)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def editor(monkeypatch):
+    """A gdpc Editor with the world slice of a flat chunk cached, no server needed as long as nothing is sent"""
+    monkeypatch.setattr(interface, "getChunks", lambda *args, **kwargs: flat_chunk_bytes())
+    editor = Editor(buffering=True)
+    editor.loadWorldSlice(Rect((0, 0), (16, 16)), cache=True)
+    return editor
+
+
+def test_recorder_keeps_its_own_decay(editor):
+    plan = GenerationPlan(0)
+    recorder = PlanRecorder(editor, plan)
+    coalescing = CoalescingEditor(recorder, skip_unchanged=True)
+
+    coalescing.placeBlock((1, 70, 1), Block("stone"))
+    # Already in the world
+    coalescing.placeBlock((2, 10, 2), Block("stone"))
+    coalescing.flushBuffer()
+
+    assert len(plan) == 1 and plan.positions[0].tolist() == [[1, 70, 1]]
+    assert recorder.worldSliceDecay[1, 70 - Y_BEGIN, 1]
+    assert recorder.worldSliceDecay.sum() == 1
+    assert not editor.worldSliceDecay.any() and not editor.worldSliceDecay.flags.writeable
+
+    # The world slice still says air there, the recorded stone must not be taken as unchanged
+    coalescing.placeBlock((1, 70, 1), Block("air"))
+    coalescing.flushBuffer()
+    assert len(plan) == 2 and plan.positions[1].tolist() == [[1, 70, 1]]
+
+
+def test_recorder_accepts_position_generators(editor):
+    plan = GenerationPlan(0)
+    recorder = PlanRecorder(editor, plan)
+    recorder.placeBlock(((x, 70, 3) for x in range(4)), Block("stone"))
+    recorder.flushBuffer()
+    assert plan.positions[0].tolist() == [[x, 70, 3] for x in range(4)]
+    assert np.array_equal(recorder.worldSliceDecay[:4, 70 - Y_BEGIN, 3], [True] * 4)
+
+
+def test_recorder_decays_filled_boxes(editor):
+    plan = GenerationPlan(0)
+    recorder = PlanRecorder(editor, plan)
+    coalescing = CoalescingEditor(recorder, skip_unchanged=True)
+
+    coalescing.runCommand("fill 1 10 1 3 12 3 air", syncWithBuffer=True)
+    coalescing.flushBuffer()
+    assert recorder.worldSliceDecay[1:4, 10 - Y_BEGIN:13 - Y_BEGIN, 1:4].all()
+    assert recorder.worldSliceDecay.sum() == 27
+
+    # The world slice still says stone there, the stone put back in the filled box must not be taken as unchanged
+    coalescing.placeBlock((2, 11, 2), Block("stone"))
+    coalescing.flushBuffer()
+    assert len(plan) == 2 and plan.positions[1].tolist() == [[2, 11, 2]]
+
+
+def test_recorder_loads_the_world_slice_when_read(monkeypatch):
+    monkeypatch.setattr(interface, "getChunks", lambda *args, **kwargs: flat_chunk_bytes())
+    monkeypatch.setattr(Editor, "getBuildArea", lambda self: Box((0, Y_BEGIN, 0), (16, 384, 16)))
+    editor = Editor(buffering=True)
+    plan = GenerationPlan(0)
+    recorder = PlanRecorder(editor, plan)
+    recorder.placeBlock((1, 70, 1), Block("stone"))
+    recorder.flushBuffer()
+    recorder.runCommand("fill 2 10 2 2 11 2 air")
+    assert editor.worldSlice is None and recorder.worldSliceDecay is None
+
+    assert recorder.worldSlice is editor.worldSlice is not None
+    # Recorded before the world slice was loaded, maybe not sent yet
+    assert recorder.worldSliceDecay[1, 70 - Y_BEGIN, 1] and recorder.worldSliceDecay[2, 10 - Y_BEGIN:12 - Y_BEGIN, 2].all()
+    assert recorder.worldSliceDecay.sum() == 3
+
+
+def test_recorder_locks_only_the_buffer_and_world_slice(editor):
+    lock = threading.Lock()
+    recorder = PlanRecorder(editor, GenerationPlan(0), lock=lock)
+    with lock:
+        # Held by the sender, reading the build area must not wait for it
+        assert recorder.getBuildArea == editor.getBuildArea
+    assert recorder.getBlock != editor.getBlock and recorder.loadWorldSlice != editor.loadWorldSlice
@@ -0,0 +1,106 @@
+import numpy as np
+
+
+def window_bounds(length, sampling, blur, origin=0):
+    """Return the clipped [low, high) bounds of the windows centered on every sampled index"""
+    centers = np.arange(origin, length, sampling)
+    return np.maximum(centers - blur, 0), np.minimum(centers + blur, length)
+
+
+def integral_image(array2d) -> np.ndarray:
+    """Summed-area table, padded with a leading row and column of zeros"""
+    table = np.zeros((array2d.shape[0] + 1, array2d.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(array2d, axis=0, dtype=np.float64), axis=1, out=table[1:, 1:])
+    return table
+
+
+def _windows_from_table(table, shape, sampling, blur, origin):
+    low_i, high_i = window_bounds(shape[0], sampling, blur, origin[0])
+    low_j, high_j = window_bounds(shape[1], sampling, blur, origin[1])
+    return table[np.ix_(high_i, high_j)] - table[np.ix_(low_i, high_j)] \
+        - table[np.ix_(high_i, low_j)] + table[np.ix_(low_i, low_j)]
+
+
+def window_sum(array2d, sampling, blur, origin=(0, 0)) -> np.ndarray:
+    return _windows_from_table(integral_image(array2d), array2d.shape, sampling, blur, origin)
+
+
+def window_nanvar(array2d, sampling, blur, origin=(0, 0)) -> np.ndarray:
+    """Variance of every sampled window, ignoring NaN like np.nanvar"""
+    valid = ~np.isnan(array2d)
+    # Centering the values keeps the sum of squares small enough to avoid cancellation
+    centered = np.where(valid, array2d - np.nanmean(array2d), 0)
+    count = window_sum(valid, sampling, blur, origin)
+    total = window_sum(centered, sampling, blur, origin)
+    total_sq = window_sum(centered ** 2, sampling, blur, origin)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = total_sq / count - (total / count) ** 2
+    return np.where(count > 0, np.maximum(variance, 0), np.nan)
+
+
+def _identity(dtype, reduce_fct):
+    if dtype == np.bool_:
+        return reduce_fct is np.minimum
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return info.max if reduce_fct is np.minimum else info.min
+    return np.inf if reduce_fct is np.minimum else -np.inf
+
+
+def _sliding_reduce_axis0(array2d, blur, reduce_fct):
+    """van Herk/Gil-Werman sliding reduction over the windows [i - blur, i + blur) along axis 0
+
+    Costs three reductions per cell whatever the window size."""
+    width = 2 * blur
+    length = array2d.shape[0]
+    identity = _identity(array2d.dtype, reduce_fct)
+    padded_length = -(-(length + width) // width) * width
+    padded = np.full((padded_length,) + array2d.shape[1:], identity, dtype=array2d.dtype)
+    padded[blur:blur + length] = array2d
+
+    blocks = padded.reshape((-1, width) + array2d.shape[1:])
+    prefix = reduce_fct.accumulate(blocks, axis=1).reshape(padded.shape)
+    suffix = reduce_fct.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(padded.shape)
+
+    # The window starting at p in padded coordinates is [p, p + width)
+    return reduce_fct(suffix[:length], prefix[width - 1:width - 1 + length])
+
+
+def _window_reduce(array2d, sampling, blur, reduce_fct, origin):
+    rows = _sliding_reduce_axis0(np.asarray(array2d), blur, reduce_fct)[origin[0]::sampling]
+    return _sliding_reduce_axis0(rows.T, blur, reduce_fct)[origin[1]::sampling].T
+
+
+def window_min(array2d, sampling, blur, origin=(0, 0)) -> np.ndarray:
+    return _window_reduce(array2d, sampling, blur, np.minimum, origin)
+
+
+def window_max(array2d, sampling, blur, origin=(0, 0)) -> np.ndarray:
+    return _window_reduce(array2d, sampling, blur, np.maximum, origin)
+
+
+def window_tile(window_fct, array2d, sampling, blur, rows, cols) -> np.ndarray:
+    """Compute window_fct only for the sampled indexes in [rows[0], rows[1]) x [cols[0], cols[1])
+
+    Only the part of the array the windows can reach is read, so a tile costs as much as its size."""
+    bounds = []
+    for (first, end), length in zip((rows, cols), array2d.shape):
+        low = max(first * sampling - blur, 0)
+        high = min((end - 1) * sampling + blur, length)
+        bounds.append((low, high, first * sampling - low))
+    (low_i, high_i, origin_i), (low_j, high_j, origin_j) = bounds
+    tile = window_fct(array2d[low_i:high_i, low_j:high_j], sampling, blur, origin=(origin_i, origin_j))
+    return tile[:rows[1] - rows[0], :cols[1] - cols[0]]
+
+
+def affected_samples(low, high, sampling, blur, sample_amount):
+    """Return the [first, end) range of sampled indexes whose window overlaps the cells [low, high)"""
+    first = max(-(-(low - blur + 1) // sampling), 0)
+    end = min((high - 1 + blur) // sampling + 1, sample_amount)
+    return first, end
+
+
+WINDOW_FUNCTIONS = {np.sum: window_sum,
+                    np.nanvar: window_nanvar,
+                    np.min: window_min,
+                    np.max: window_max}
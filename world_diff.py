@@ -0,0 +1,86 @@
+import numpy as np
+from gdpc import Block
+
+from coord_batch import CoordBatch
+from terrain_analysis import iter_sections, decode_block_states
+
+
+def normalize_id(block_id: str) -> str:
+    return block_id if ':' in block_id else 'minecraft:' + block_id
+
+
+def block_key(block: Block):
+    """Hashable description of a block, None for blocks carrying block entity data as they can not be compared"""
+    if block.data:
+        return None
+    return normalize_id(block.id), tuple(sorted((str(k), str(v)) for k, v in block.states.items()))
+
+
+def state_tag_key(tag):
+    properties = tag['Properties'].tags if 'Properties' in tag else []
+    return normalize_id(tag['Name'].value), tuple(sorted((p.name, str(p.value)) for p in properties))
+
+
+class WorldSliceBlocks:
+    """Palette-indexed view of the blocks of a world slice
+
+    Block states from every section palette and from the planned blocks share a single palette, so comparing
+    blocks is comparing integers. Sections are decoded on first access."""
+
+    UNKNOWN = -1
+
+    def __init__(self, world_slice):
+        self.world_slice = world_slice
+        self.chunk_offset = world_slice.chunkRect.offset[0], world_slice.chunkRect.offset[1]
+        self.sections = {(chunk_x, section_y, chunk_z): (palette, data)
+                         for chunk_x, section_y, chunk_z, palette, data in iter_sections(world_slice)}
+        self.decoded: dict[tuple[int, int, int], np.ndarray] = {}
+        self.palette: dict[tuple, int] = {}
+
+    def palette_id(self, key) -> int:
+        if key is None:
+            return self.UNKNOWN
+        if key not in self.palette:
+            self.palette[key] = len(self.palette)
+        return self.palette[key]
+
+    def __decoded_section(self, section) -> np.ndarray:
+        if section not in self.decoded:
+            palette, data = self.sections[section]
+            ids = np.array([self.palette_id(state_tag_key(tag)) for tag in palette], dtype=np.int32)
+            self.decoded[section] = ids[decode_block_states(data, len(palette))]
+        return self.decoded[section]
+
+    def block_ids(self, batch: CoordBatch) -> np.ndarray:
+        """Return the palette id of the world block at every row of the batch, UNKNOWN outside of the slice box"""
+        ids = np.full(len(batch), self.UNKNOWN, dtype=np.int32)
+        if not len(batch):
+            return ids
+        sections = np.column_stack(((batch[:, 0] >> 4) - self.chunk_offset[0], batch[:, 1] >> 4,
+                                    (batch[:, 2] >> 4) - self.chunk_offset[1]))
+        unique_sections, inverse = np.unique(sections, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        box = self.world_slice.box
+        inside = np.all((batch >= np.array(tuple(box.begin))) & (batch < np.array(tuple(box.end))), axis=1)
+        for k, section in enumerate(map(tuple, unique_sections.tolist())):
+            if section not in self.sections:
+                continue
+            rows = np.flatnonzero((inverse == k) & inside)
+            local = batch[rows] & 15
+            ids[rows] = self.__decoded_section(section)[local[:, 1], local[:, 2], local[:, 0]]
+        return ids
+
+    def changed_mask(self, batch: CoordBatch, blocks: list[Block], decay=None) -> np.ndarray:
+        """Return which planned blocks differ from the world slice
+
+        Blocks that can not be compared, outside of the slice, or at a position the editor changed since the slice
+        was loaded (decay) are considered changed."""
+        planned = np.array([self.palette_id(block_key(block)) for block in blocks], dtype=np.int32)
+        world = self.block_ids(batch)
+        changed = (planned == self.UNKNOWN) | (world == self.UNKNOWN) | (planned != world)
+        if decay is not None and len(batch):
+            box = self.world_slice.box
+            local = batch - np.array((box.offset[0], box.offset[1], box.offset[2]), dtype=np.int32)
+            inside = np.all((local >= 0) & (local < np.array(decay.shape)), axis=1)
+            changed[inside] |= decay[local[inside, 0], local[inside, 1], local[inside, 2]]
+        return changed